@@ -5,3 +5,16 @@ from .nda_functions import cycle
 from .nda_functions import recipe
 from .nda_functions import step
 from .nda_functions import records
+from .nda_functions import iter_records
+from .nda_functions import summaries
+from .nda_functions import validate
+from .nda_functions import aux
+from .nda_cache import enable_cache
+from .nda_cache import disable_cache
+from .nda_cache import clear_cache
+from .nda_version_8_0 import IncrementalReader
+from .nda_file import NdaFile
+from .nda_batch import records_many
+from .nda_batch import cycle_many
+from .nda_batch import step_many
+from .nda_profile import profile
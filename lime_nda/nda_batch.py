@@ -0,0 +1,106 @@
+# Decoding many nda files in parallel
+
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import nda_cache
+from . import nda_functions
+
+
+def _work(kind, nda, out, rename):
+    """
+    Runs records/cycle/step on one file inside a worker process.
+
+    The result is written column-wise under out and only its location is
+    sent back, so large frames are not pickled between processes. Errors are
+    returned rather than raised so one bad file does not stop the batch.
+    """
+    try:
+        if kind == 'records':
+            df = nda_functions.records(nda, rename)
+        else:
+            df = getattr(nda_functions, kind)(nda)
+        if nda_cache.can_store(df):
+            nda_cache.write_table(out, df)
+            return out, None
+        return df, None
+    except Exception as e:
+        return None, e
+
+
+def iter_many(kind, paths, workers=None, rename=False):
+    '''
+    Runs records, cycle or step (named by kind) on every file in paths using
+    a pool of worker processes, and yields (path, DataFrame, error) tuples as
+    the files complete. error is None on success; otherwise DataFrame is None
+    and error holds the exception raised for that file.
+    workers defaults to the number of cores; with workers=1 the files are
+    decoded in this process.
+    '''
+    if kind not in ('records', 'cycle', 'step'):
+        raise ValueError("kind must be one of 'records', 'cycle' or 'step'")
+    paths = list(paths)
+    handoff = tempfile.mkdtemp(prefix='lime_nda_')
+    try:
+        if workers == 1:
+            for i, nda in enumerate(paths):
+                yield (nda, *_collect(*_work(kind, nda, os.path.join(handoff, str(i)), rename)))
+            return
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_work, kind, nda, os.path.join(handoff, str(i)), rename): nda
+                       for i, nda in enumerate(paths)}
+            for future in as_completed(futures):
+                try:
+                    result, error = future.result()
+                except Exception as e:
+                    # e.g. a worker killed by the OS while decoding this file
+                    result, error = None, e
+                yield (futures[future], *_collect(result, error))
+    finally:
+        shutil.rmtree(handoff, ignore_errors=True)
+
+
+def _collect(result, error):
+    """Load a result written by _work back into memory"""
+    if isinstance(result, str):
+        df = nda_cache.read_table(result, mmap=False)
+        shutil.rmtree(result, ignore_errors=True)
+        return df, error
+    return result, error
+
+
+def _many(kind, paths, workers, rename=False):
+    results = {}
+    errors = {}
+    for nda, df, error in iter_many(kind, paths, workers, rename):
+        if error is None:
+            results[nda] = df
+        else:
+            errors[nda] = error
+    return results, errors
+
+
+def records_many(paths, workers=None, rename=False):
+    '''
+    Decodes every nda file in paths in parallel.
+    Returns (results, errors): results maps each decoded path to its records
+    DataFrame and errors maps each path that failed to its exception.
+    '''
+    return _many('records', paths, workers, rename)
+
+
+def cycle_many(paths, workers=None):
+    '''
+    Cycle-wise data for every nda file in paths, computed in parallel.
+    Returns (results, errors) like records_many.
+    '''
+    return _many('cycle', paths, workers)
+
+
+def step_many(paths, workers=None):
+    '''
+    Step-wise data for every nda file in paths, computed in parallel.
+    Returns (results, errors) like records_many.
+    '''
+    return _many('step', paths, workers)
@@ -0,0 +1,161 @@
+# Throughput and memory benchmarks of the readers on synthetic nda files
+#
+#   python -m lime_nda.nda_benchmark --sizes 10000 1000000 --output results.csv
+#   python -m lime_nda.nda_benchmark --baseline results.csv
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import pandas as pd
+from . import nda_cache
+from . import nda_functions
+from . import nda_synthetic
+from . import nda_version_8_0
+
+# Record counts of the default files
+DEFAULT_SIZES = (10000, 1000000, 50000000)
+
+RESULT_COLUMNS = ['case', 'records', 'file_MB', 'seconds', 'records_per_s', 'MB_per_s', 'peak_MB']
+
+
+def _metadata(nda):
+    nda_version_8_0._cached_header.cache_clear()
+    return (nda_functions.get_barcode(nda), nda_functions.get_process_name(nda),
+            nda_functions.get_start_time(nda), nda_version_8_0.get_remarks(nda))
+
+
+# Each case is (name, needs the records frame, function of (nda, records))
+CASES = [
+    ('metadata', False, lambda nda, df: _metadata(nda)),
+    ('nda_in_df_out', False, lambda nda, df: nda_version_8_0.nda_in_df_out(nda)),
+    ('records', False, lambda nda, df: nda_functions.records(nda)),
+    ('records_compact', False, lambda nda, df: nda_functions.records(nda, compact=True)),
+    ('cycle', True, lambda nda, df: nda_functions.cycle(df)),
+    ('step', True, lambda nda, df: nda_functions.step(df)),
+    ('recipe', True, lambda nda, df: nda_functions.recipe(df)),
+]
+
+
+def synthetic_file(directory, records, aux_channels=1):
+    '''
+    Path of the synthetic benchmark file with records main records under
+    directory, written with nda_synthetic.write_nda unless it already exists.
+    '''
+    path = os.path.join(directory, f"synthetic_{records}_aux{aux_channels}.nda")
+    if not os.path.exists(path):
+        tmp = path + '.tmp'
+        nda_synthetic.write_nda(tmp, records, aux_channels=aux_channels)
+        os.replace(tmp, path)
+    return path
+
+
+def measure(function, *args, repeat=1):
+    '''
+    Runs function(*args) repeat times untraced and keeps the fastest time,
+    then once more under tracemalloc for the memory, as tracing every
+    allocation slows the call down. Returns (result, seconds, peak bytes)
+    where the peak is the largest amount of memory traced during that last
+    call (numpy and pandas buffers included) above what was in use before it.
+    '''
+    seconds = float('inf')
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function(*args)
+        seconds = min(seconds, time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run(sizes=DEFAULT_SIZES, directory='.', cases=None, aux_channels=1, repeat=1, log=None):
+    '''
+    Benchmarks the readers on a synthetic file of every size in sizes
+    (created under directory on first use and reused afterwards). cases
+    limits the run to the named entries of CASES. Returns a DataFrame with
+    one row per case and size: the wall time, the throughput in records and
+    file megabytes per second, and the peak traced memory (see measure);
+    with repeat > 1 each case is timed that many times and the fastest time
+    is kept. The
+    on-disk cache is turned off for the run so every case decodes the file.
+    log, when given, is called with each result row as it completes.
+    '''
+    selected = [case for case in CASES if cases is None or case[0] in cases]
+    unknown = set(cases or []) - {name for name, _, _ in CASES}
+    if unknown:
+        raise ValueError(f"Unknown benchmark cases {sorted(unknown)}")
+
+    os.makedirs(directory, exist_ok=True)
+    cache_directory = nda_cache._config['directory']
+    nda_cache.disable_cache()
+    rows = []
+    try:
+        for records in sizes:
+            nda = synthetic_file(directory, records, aux_channels)
+            file_MB = os.path.getsize(nda) / 1e6
+            df = None
+            if any(needs_records for _, needs_records, _ in selected):
+                df = nda_version_8_0.nda_in_df_out(nda)
+            for name, _, function in selected:
+                _, seconds, peak = measure(function, nda, df, repeat=repeat)
+                row = [name, records, file_MB, seconds, records / seconds, file_MB / seconds, peak / 1e6]
+                rows.append(row)
+                if log is not None:
+                    log(dict(zip(RESULT_COLUMNS, row)))
+            del df
+    finally:
+        nda_cache._config['directory'] = cache_directory
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def compare(results, baseline):
+    '''
+    Joins results with an earlier run of the same cases and sizes, adding
+    the speedup (baseline seconds / seconds, below 1 for a regression) and
+    the ratio of peak memory to the baseline's.
+    '''
+    merged = results.merge(baseline[['case', 'records', 'seconds', 'peak_MB']],
+                           on=['case', 'records'], how='left', suffixes=('', '_baseline'))
+    merged['speedup'] = merged['seconds_baseline'] / merged['seconds']
+    merged['memory_ratio'] = merged['peak_MB'] / merged['peak_MB_baseline']
+    return merged.drop(columns=['seconds_baseline', 'peak_MB_baseline'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m lime_nda.nda_benchmark',
+                                     description='Benchmark the nda readers on synthetic files.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(DEFAULT_SIZES),
+                        help='record counts of the synthetic files (default: %(default)s)')
+    parser.add_argument('--cases', nargs='+', choices=[name for name, _, _ in CASES],
+                        help='cases to run (default: all)')
+    parser.add_argument('--directory', default='.', help='where the synthetic files are kept')
+    parser.add_argument('--aux-channels', type=int, default=1, help='temperature channels per record')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per case; the fastest is reported')
+    parser.add_argument('--output', help='write the results to this CSV file')
+    parser.add_argument('--baseline', help='CSV of an earlier run to compare against')
+    args = parser.parse_args(argv)
+
+    def log(row):
+        print(f"{row['case']:>16} {row['records']:>10} records {row['seconds']:9.3f} s "
+              f"{row['records_per_s']:12.0f} rec/s {row['MB_per_s']:8.1f} MB/s {row['peak_MB']:9.1f} MB peak",
+              flush=True)
+
+    results = run(args.sizes, args.directory, args.cases, args.aux_channels, args.repeat, log)
+    if args.output:
+        results.to_csv(args.output, index=False)
+    if args.baseline:
+        with pd.option_context('display.width', 200, 'display.max_columns', None):
+            print(compare(results, pd.read_csv(args.baseline)).to_string(index=False))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+# Persistent on-disk cache for decoded nda data
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Bump whenever the decoded output changes, so stale entries are not reused
+CACHE_VERSION = 4
+
+_config = {
+    'directory': os.environ.get('LIME_NDA_CACHE_DIR'),
+    'max_bytes': 10 * 1024**3,
+}
+
+
+def enable_cache(directory=None, max_bytes=10 * 1024**3):
+    '''
+    Turns on the on-disk cache for records, cycle and step.
+    Entries are stored under directory (default ~/.cache/lime_nda) and the
+    least recently used ones are evicted once the cache grows past max_bytes.
+    The cache can also be turned on by setting LIME_NDA_CACHE_DIR.
+    '''
+    if directory is None:
+        directory = os.path.join(os.path.expanduser('~'), '.cache', 'lime_nda')
+    os.makedirs(directory, exist_ok=True)
+    _config['directory'] = directory
+    _config['max_bytes'] = max_bytes
+
+
+def disable_cache():
+    '''
+    Turns off the on-disk cache. Existing entries are kept.
+    '''
+    _config['directory'] = None
+
+
+def clear_cache():
+    '''
+    Removes every entry from the cache directory.
+    '''
+    directory = _config['directory']
+    if directory is None or not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def enabled():
+    return _config['directory'] is not None
+
+
+def fingerprint(nda):
+    '''
+    Key of an nda file in the cache: its absolute path, size and mtime.
+    '''
+    st = os.stat(nda)
+    key = f"{CACHE_VERSION}|{os.path.abspath(nda)}|{st.st_size}|{st.st_mtime_ns}"
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _entry_size(path):
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+
+def _evict(directory, max_bytes):
+    """Delete least recently used entries until the cache fits in max_bytes"""
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not name.startswith('.'):
+            entries.append((os.path.getmtime(path), _entry_size(path), path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+
+
+def can_store(df):
+    """Only frames with a default index and string-only object or categorical columns are cached"""
+    if not df.index.equals(pd.RangeIndex(len(df))):
+        return False
+    for col in df.columns:
+        s = df[col]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            continue
+        if (not isinstance(s.dtype, np.dtype) or s.dtype == object) and \
+                pd.api.types.infer_dtype(s, skipna=False) not in ('string', 'empty'):
+            return False
+    return True
+
+
+def write_table(path, df):
+    """Store df column-wise: one .npy per column, strings as codes + categories"""
+    os.makedirs(path)
+    columns = []
+    for i, col in enumerate(df.columns):
+        s = df[col]
+        meta = {'name': col, 'dtype': str(s.dtype)}
+        if isinstance(s.dtype, np.dtype) and s.dtype != object:
+            values = s.to_numpy()
+        elif isinstance(s.dtype, pd.CategoricalDtype):
+            values = s.cat.codes.to_numpy()
+            meta['categories'] = list(s.cat.categories)
+            meta['ordered'] = bool(s.cat.ordered)
+        else:
+            values, categories = pd.factorize(s)
+            meta['categories'] = list(categories)
+        np.save(os.path.join(path, f'{i}.npy'), values)
+        columns.append(meta)
+    with open(os.path.join(path, 'columns.json'), 'w') as f:
+        json.dump({'length': len(df), 'columns': columns}, f)
+
+
+def read_table(path, mmap=True):
+    """
+    Inverse of write_table. With mmap the numeric columns are memory-mapped
+    (copy-on-write) instead of read, otherwise they are read into memory.
+    """
+    with open(os.path.join(path, 'columns.json')) as f:
+        meta = json.load(f)
+    data = {}
+    for i, col in enumerate(meta['columns']):
+        values = np.asarray(np.load(os.path.join(path, f'{i}.npy'), mmap_mode='c' if mmap else None))
+        if col['dtype'] == 'category':
+            values = pd.Categorical.from_codes(values, categories=col['categories'], ordered=col['ordered'])
+        elif 'categories' in col:
+            values = np.asarray(col['categories'], dtype=object)[values]
+            if col['dtype'] != 'object':
+                values = pd.Series(values).astype(col['dtype']).to_numpy()
+        data[col['name']] = values
+    return pd.DataFrame(data, index=pd.RangeIndex(meta['length']), copy=False)
+
+
+def cached(table, nda, compute):
+    '''
+    Returns compute(nda), going through the on-disk cache when it is enabled.
+    table names the result (e.g. 'records', 'cycle', 'step') so several
+    results of the same file can be stored side by side.
+    '''
+    directory = _config['directory']
+    if directory is None:
+        return compute(nda)
+
+    entry = os.path.join(directory, fingerprint(nda))
+    path = os.path.join(entry, table)
+    if os.path.isfile(os.path.join(path, 'columns.json')):
+        try:
+            df = read_table(path)
+            os.utime(entry)
+            return df
+        except (OSError, ValueError, KeyError):
+            shutil.rmtree(path, ignore_errors=True)
+
+    df = compute(nda)
+    if can_store(df):
+        # Write to a temporary directory first so concurrent jobs never see
+        # half-written tables
+        os.makedirs(entry, exist_ok=True)
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=directory)
+        try:
+            write_table(os.path.join(tmp, table), df)
+            os.replace(os.path.join(tmp, table), path)
+        except OSError:
+            pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        os.utime(entry)
+        _evict(directory, _config['max_bytes'])
+    return df
@@ -0,0 +1,261 @@
+# Command line interface: lime-nda convert
+#
+#   lime-nda convert /data/nightly --output /data/parquet --workers 8
+#   lime-nda convert 'runs/**/*.nda' --tables records step --format csv
+
+import argparse
+import glob
+import importlib.util
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from . import nda_cache
+from . import nda_file
+
+TABLES = ['records', 'cycle', 'step', 'aux']
+
+# File extension of every output format
+FORMATS = {'parquet': 'parquet', 'feather': 'feather', 'csv': 'csv'}
+
+# Conversion state kept in every output directory, so unchanged files are skipped
+MANIFEST = '.lime_nda_convert.json'
+
+
+def find_inputs(patterns):
+    '''
+    nda files named by patterns: files, directories (searched recursively for
+    *.nda) and glob patterns ('**' matches any number of directories). Returns
+    (paths, unmatched), the paths in order without repeats and the patterns
+    that matched no file.
+    '''
+    paths = []
+    seen = set()
+    unmatched = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, '**', '*.nda'), recursive=True))
+        elif any(c in pattern for c in '*?['):
+            matches = sorted(p for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+        else:
+            matches = [pattern] if os.path.isfile(pattern) else []
+        if not matches:
+            unmatched.append(pattern)
+        for path in matches:
+            key = os.path.abspath(path)
+            if key not in seen:
+                seen.add(key)
+                paths.append(path)
+    return paths, unmatched
+
+
+def _targets(nda, output, tables, fmt):
+    """Output path of every table of nda: <stem>_<table>.<ext> in output, or next to nda"""
+    directory = output if output is not None else os.path.dirname(os.path.abspath(nda))
+    stem = os.path.splitext(os.path.basename(nda))[0]
+    return {table: os.path.join(directory, f"{stem}_{table}.{FORMATS[fmt]}") for table in tables}
+
+
+def _signature(nda, tables, fmt, compact):
+    """What an up to date conversion of nda was made from: the file's size and mtime and the options"""
+    st = os.stat(nda)
+    return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'tables': sorted(tables), 'format': fmt,
+            'compact': compact, 'version': nda_cache.CACHE_VERSION}
+
+
+def _load_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(directory, manifest):
+    """Write the manifest atomically, so an interrupted run never leaves it half written"""
+    fd, tmp = tempfile.mkstemp(prefix='.manifest-', dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(directory, MANIFEST))
+
+
+def _write(df, path, fmt):
+    """Write df to path through a temporary file, without its index"""
+    tmp = os.path.join(os.path.dirname(path), '.' + os.path.basename(path) + '.tmp')
+    try:
+        if fmt == 'parquet':
+            df.to_parquet(tmp, index=False)
+        elif fmt == 'feather':
+            df.reset_index(drop=True).to_feather(tmp)
+        else:
+            df.to_csv(tmp, index=False)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def convert_file(nda, targets, fmt, compact=False):
+    '''
+    Converts one nda file: every table in targets (a dict of table name to
+    output path) is written in fmt. The file is decoded once for all of
+    them. Returns the number of records written (0 when records, cycle and
+    step are not among the tables).
+    '''
+    with nda_file.NdaFile(nda, compact=compact) as session:
+        tables = {
+            'records': lambda: session.records,
+            'cycle': lambda: session.cycles,
+            'step': lambda: session.steps,
+            'aux': lambda: session.aux.reset_index(),
+        }
+        for table, path in targets.items():
+            _write(tables[table](), path, fmt)
+        return len(session.records) if set(targets) & {'records', 'cycle', 'step'} else 0
+
+
+def _work(nda, targets, fmt, compact):
+    """convert_file in a worker process; errors are returned rather than raised"""
+    start = time.perf_counter()
+    try:
+        return convert_file(nda, targets, fmt, compact), time.perf_counter() - start, None
+    except Exception as e:
+        return 0, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+
+
+def convert(paths, output=None, tables=('records', 'cycle', 'step'), fmt='parquet', workers=None,
+            compact=False, force=False, log=print):
+    '''
+    Converts every nda file in paths, in workers processes (default: one per
+    core; with workers=1 in this process). Files whose size and modification
+    time match their last conversion with the same options, and whose
+    outputs still exist, are skipped unless force is set. log is called with
+    a progress line per file and a summary at the end. Returns a dict of
+    counts: converted, skipped, failed, records, bytes and seconds.
+    '''
+    started = time.perf_counter()
+    tables = list(tables)
+    if output is not None:
+        os.makedirs(output, exist_ok=True)
+
+    all_targets = [_targets(nda, output, tables, fmt) for nda in paths]
+    sources = {}
+    for nda, targets in zip(paths, all_targets):
+        for path in targets.values():
+            if path in sources:
+                raise ValueError(f"{sources[path]} and {nda} would both be written to {path}; "
+                                 "convert them to separate output directories")
+            sources[path] = nda
+
+    manifests = {}
+    jobs = []
+    skipped = 0
+    for nda, targets in zip(paths, all_targets):
+        directory = os.path.dirname(next(iter(targets.values())))
+        manifest = manifests.setdefault(directory, _load_manifest(directory))
+        signature = _signature(nda, tables, fmt, compact)
+        key = os.path.abspath(nda)
+        if not force and manifest.get(key) == signature and all(os.path.exists(p) for p in targets.values()):
+            skipped += 1
+            continue
+        jobs.append((nda, targets, directory, key, signature))
+
+    counts = {'converted': 0, 'skipped': skipped, 'failed': 0, 'records': 0, 'bytes': 0}
+    changed = set()
+    saved = time.perf_counter()
+
+    def save():
+        for directory in changed:
+            _save_manifest(directory, manifests[directory])
+        changed.clear()
+
+    def finished(job, result, done):
+        nonlocal saved
+        nda, targets, directory, key, signature = job
+        records, seconds, error = result
+        if error is None:
+            counts['converted'] += 1
+            counts['records'] += records
+            counts['bytes'] += signature['size']
+            manifests[directory][key] = signature
+            changed.add(directory)
+            log(f"[{done}/{len(jobs)}] {nda}: {records} records in {seconds:.2f} s")
+        else:
+            counts['failed'] += 1
+            log(f"[{done}/{len(jobs)}] {nda}: FAILED {error}")
+        # Record progress now and then, so an interrupted run resumes
+        # without redoing everything
+        if time.perf_counter() - saved > 10:
+            save()
+            saved = time.perf_counter()
+
+    try:
+        if workers == 1 or len(jobs) <= 1:
+            for done, job in enumerate(jobs, 1):
+                finished(job, _work(job[0], job[1], fmt, compact), done)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(_work, job[0], job[1], fmt, compact): job for job in jobs}
+                for done, future in enumerate(as_completed(futures), 1):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # e.g. a worker killed by the OS while decoding this file
+                        result = 0, 0.0, f"{type(e).__name__}: {e}"
+                    finished(futures[future], result, done)
+    finally:
+        save()
+
+    counts['seconds'] = time.perf_counter() - started
+    elapsed = max(counts['seconds'], 1e-9)
+    log(f"{counts['converted']} converted, {counts['skipped']} skipped, {counts['failed']} failed: "
+        f"{counts['records']} records, {counts['bytes'] / 1e6:.1f} MB in {counts['seconds']:.1f} s "
+        f"({counts['records'] / elapsed:.0f} records/s, {counts['bytes'] / 1e6 / elapsed:.1f} MB/s)")
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='lime-nda', description='Tools for Neware nda files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    cmd = commands.add_parser('convert', help='convert nda files to Parquet, Feather or CSV tables',
+                              description='Decode nda files and write their tables as <stem>_<table>.<format>.')
+    cmd.add_argument('inputs', nargs='+', help='nda files, directories (searched recursively) or glob patterns')
+    cmd.add_argument('-o', '--output', help='output directory (default: next to each nda file)')
+    cmd.add_argument('-t', '--tables', nargs='+', choices=TABLES, default=['records', 'cycle', 'step'],
+                     help='tables to write (default: records cycle step)')
+    cmd.add_argument('-f', '--format', choices=list(FORMATS), default='parquet',
+                     help='output format (default: parquet; parquet and feather need pyarrow)')
+    cmd.add_argument('-j', '--workers', type=int, default=None,
+                     help='worker processes (default: one per core)')
+    cmd.add_argument('--compact', action='store_true', help='decode with compact=True to save memory')
+    cmd.add_argument('--force', action='store_true', help='convert files even if they are unchanged')
+    cmd.add_argument('-q', '--quiet', action='store_true', help='only print the summary')
+    args = parser.parse_args(argv)
+
+    if args.format in ('parquet', 'feather') and importlib.util.find_spec('pyarrow') is None:
+        print(f"lime-nda: {args.format} output needs pyarrow (pip install lime_nda[parquet]), "
+              "or use --format csv", file=sys.stderr)
+        return 2
+    paths, unmatched = find_inputs(args.inputs)
+    for pattern in unmatched:
+        print(f"lime-nda: no nda files match {pattern}", file=sys.stderr)
+    if not paths:
+        return 2
+
+    def log(line):
+        if not args.quiet or not line.startswith('['):
+            print(line, file=sys.stderr, flush=True)
+
+    try:
+        counts = convert(paths, args.output, args.tables, args.format, args.workers, args.compact,
+                         args.force, log)
+    except ValueError as e:
+        print(f"lime-nda: {e}", file=sys.stderr)
+        return 2
+    return 1 if counts['failed'] or unmatched else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# Session object over one nda file
+
+import os
+from . import nda_cache
+from . import nda_functions
+from . import nda_version_8_0
+
+
+class NdaFile:
+    """
+    One nda file, decoded at most once.
+
+    The header, records, aux, cycles, steps, recipes and validation
+    properties are computed on first access and kept, and cycles, steps,
+    recipes and validation are all derived from the same records frame, so
+    a report touching several of them decodes the file once. The options
+    are those of records(). release() drops everything computed so far (the
+    object can be used as a context manager to release on exit).
+    """
+
+    def __init__(self, path, workers=1, validate=True, aux=True, compact=False):
+        if not isinstance(path, (str, os.PathLike)) or str(path).split('.')[-1] != 'nda':
+            raise ValueError("File passed in function is not an nda file")
+        self.path = path
+        self.workers = workers
+        self.validate = validate
+        self.aux_columns = aux
+        self.compact = compact
+        self._memo = {}
+
+    def __repr__(self):
+        return f"NdaFile({self.path!r})"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def release(self):
+        '''
+        Frees every table computed so far; they are computed again on next access.
+        '''
+        self._memo.clear()
+
+    def _get(self, name, compute):
+        if name not in self._memo:
+            self._memo[name] = compute()
+        return self._memo[name]
+
+    def _summary(self, table, summarise):
+        """summarise(records), through the on-disk cache unless the records are already decoded"""
+        if 'records' in self._memo or not nda_cache.enabled():
+            return summarise(self.records)
+        name = nda_functions._table_name(table, self.validate, self.aux_columns, self.compact)
+        return nda_cache.cached(name, self.path, lambda nda: summarise(self.records))
+
+    @property
+    def header(self):
+        '''NdaHeader with the barcode, process name, start time and remarks'''
+        return self._get('header', lambda: nda_version_8_0.read_header(self.path))
+
+    @property
+    def records(self):
+        '''Record-wise DataFrame, as returned by records()'''
+        return self._get('records', lambda: nda_functions._decode(
+            self.path, self.workers, self.validate, self.aux_columns, self.compact))
+
+    @property
+    def aux(self):
+        '''Temperature channels, as returned by aux()'''
+        return self._get('aux', lambda: nda_version_8_0.read_aux(self.path))
+
+    @property
+    def cycles(self):
+        '''Cycle-wise DataFrame, as returned by cycle()'''
+        return self._get('cycles', lambda: self._summary('cycle', nda_functions.cycle))
+
+    @property
+    def steps(self):
+        '''Step-wise DataFrame, as returned by step()'''
+        return self._get('steps', lambda: self._summary('step', nda_functions.step))
+
+    @property
+    def recipes(self):
+        '''(recipes, recipe_cycles), as returned by recipe()'''
+        return self._get('recipes', lambda: nda_functions.recipe(self.records))
+
+    @property
+    def validation(self):
+        '''(flags, report), as returned by validate()'''
+        return self._get('validation', lambda: nda_functions.validate(self.records))
@@ -1,11 +1,14 @@
 # Libraries
 
-from sys import displayhook
 import pandas as pd
 import numpy as np
 from datetime import timedelta
 import re
 from . import nda_version_8_0
+from . import nda_cache
+from . import nda_index
+from . import nda_file
+from . import nda_profile
 
 
 def _validator_cycle(df):
@@ -20,15 +23,26 @@ def _validator_cycle(df):
        'End_of_Chg_Current_(A)', 'End_of_DChg_Current_(A)', 'DCIR(mΩ)'],
        dtype='object')
     '''
-    for id, i in df.iterrows():
-        if (pd.to_datetime(i['End_Date']) > pd.to_datetime(i['Onset_Date'])):
-            raise ValueError('Date error with cycle number '+str(i['Cycle_Index']))
-        if (i["Cycle_Index"] < 1):
-            raise ValueError('Cycle Index out of range; please check data.')
-        if (i['Chg_Onset_Volt_(V)'] < 1.5 or i['DChg_Onset_Volt_(V)'] < 1.5):
-            raise ValueError('Voltage value too low in cycle number '+str(i['Cycle_Index']))
-        if (i['DCIR(mΩ)'] < 0):
-            raise ValueError('DCIR is negative in cycle number '+str(i['Cycle_Index']))
+    _raise_first_failure(df, 'Cycle_Index', [
+        (pd.to_datetime(df['End_Date']) > pd.to_datetime(df['Onset_Date']), 'Date error with cycle number {}'),
+        (df['Cycle_Index'] < 1, 'Cycle Index out of range; please check data.'),
+        ((df['Chg_Onset_Volt_(V)'] < 1.5) | (df['DChg_Onset_Volt_(V)'] < 1.5), 'Voltage value too low in cycle number {}'),
+        (df['DCIR(mΩ)'] < 0, 'DCIR is negative in cycle number {}'),
+    ])
+
+
+def _raise_first_failure(df, label, checks):
+    '''
+    raises a ValueError for the first row failing one of checks, a list of
+    (mask, message) pairs tried in order for each row; {} in the message is
+    replaced by the row's label column.
+    '''
+    failed = np.column_stack([np.asarray(mask, dtype=bool) for mask, _ in checks])
+    rows = np.flatnonzero(failed.any(axis=1))
+    if len(rows):
+        row = rows[0]
+        message = checks[np.argmax(failed[row])][1]
+        raise ValueError(message.format(df[label].iloc[row]))
 
 def get_barcode(nda):
     '''
@@ -57,35 +71,135 @@ def get_process_name(nda):
     return nda_version_8_0.get_process_name(nda)
 
 
-def records(nda, rename=False):
+excel_columns = {
+    'record_ID': 'DataPoint',
+    'cycle': 'Cycle Index',
+    'step_ID': 'Step Index',
+    'step_name': 'Step Type',
+    'time_in_step': 'Time',
+    'voltage_V': 'Voltage(V)',
+    'current_mA': 'Current(A)',
+    'capacity_mAh': 'Capacity(Ah)',
+    'energy_mWh': 'Energy(Wh)',
+    'timestamp': 'Date',
+    'Validated': 'Validated'
+    }
+
+
+def _rename_records(df):
+    '''
+    converts units and renames the record columns to the NEWARE excel names
+    '''
+    for col in ('current_mA', 'capacity_mAh', 'energy_mWh'):
+        if col in df:
+            df[col] = df[col].div(1000)
+    return df.rename(columns = excel_columns)
+
+
+def _table_name(table, validate=True, aux=True, compact=False):
+    '''
+    name of a cached table of an nda file decoded with the given options
+    '''
+    return table + ('' if validate else '_unvalidated') + ('' if aux else '_noaux') + ('_compact' if compact else '')
+
+
+def _decode(nda, workers=1, validate=True, aux=True, compact=False):
+    '''
+    decodes the nda file, through the on-disk cache when it is enabled
+    '''
+    table = _table_name('records', validate, aux, compact)
+    return nda_cache.cached(table, nda,
+                            lambda nda: nda_version_8_0.nda_in_df_out(nda, workers, validate, aux, compact))
+
+
+def records(nda, rename=False, workers=1, validate=True, aux=True, compact=False,
+            columns=None, cycles=None, time_range=None):
     '''
     returns a Dataframe record-wise for the nda file
     Use the rename arguement if you want to rename the columns
+    Use workers to decode large files on several cores
+    Use validate=False to skip the per-record checks while decoding (the
+    Validated column is then left out and an ID_flags column keeps the checks
+    of the raw record index and step); run validate on the result later
+    Use aux=False to leave out the temperature columns; aux returns them
+    separately
+    Use compact=True to hold the records in about 46 bytes each, with
+    step_name as a Categorical
+    Use columns, cycles and time_range=(start, end) to decode only those
+    columns of the records in those cycles and that time range; the rows
+    keep their index in the full records. cycles are looked up in a sidecar
+    index (built on first use), so only their records are read
     '''
     if (nda.split('.')[-1] != 'nda'):
         raise ValueError("File passed in function is not an nda file")
-    df = nda_version_8_0.nda_in_df_out(nda)
-    rec_columns = {
-        'record_ID': 'DataPoint',
-        'cycle': 'Cycle Index',
-        'step_ID': 'Step Index',
-        'step_name': 'Step Type',
-        'time_in_step': 'Time',
-        'voltage_V': 'Voltage(V)',
-        'current_mA': 'Current(A)',
-        'capacity_mAh': 'Capacity(Ah)',
-        'energy_mWh': 'Energy(Wh)',
-        'timestamp': 'Date',
-        'Validated': 'Validated'
-        }
+    if cycles is not None:
+        df = nda_index.read_cycles(nda, cycles, columns, time_range, validate, aux, compact)
+    elif columns is not None or time_range is not None:
+        df = nda_version_8_0.select_records(nda, columns, cycles, time_range, validate, aux, compact)
+    else:
+        df = nda_file.NdaFile(nda, workers, validate, aux, compact).records
     if (rename == True):
-        df['current_mA'] = df['current_mA'].div(1000)
-        df['capacity_mAh'] = df['capacity_mAh'].div(1000)
-        df['energy_mWh'] = df['energy_mWh'].div(1000)
-        df=df.rename(columns = rec_columns)
+        df = _rename_records(df)
     return df
 
 
+def aux(nda):
+    '''
+    returns the auxiliary (temperature) data of the nda file as a float32
+    DataFrame with one T{channel} column per channel, indexed by the record
+    index the readings belong to
+    '''
+    if (nda.split('.')[-1] != 'nda'):
+        raise ValueError("File passed in function is not an nda file")
+    return nda_version_8_0.read_aux(nda)
+
+
+def iter_records(nda, chunk_size=1000000, rename=False):
+    '''
+    yields the records of the nda file in chunks of at most chunk_size
+    records, as (records, aux) pairs of DataFrames, so files of any size
+    can be processed in bounded memory.
+    Use the rename arguement if you want to rename the columns
+    '''
+    if (nda.split('.')[-1] != 'nda'):
+        raise ValueError("File passed in function is not an nda file")
+    for df, aux in nda_version_8_0.iter_records(nda, chunk_size):
+        if (rename == True):
+            df = _rename_records(df)
+        yield df, aux
+
+
+
+def validate(df, capacity_nom=None):
+    '''
+    When passed an nda file or the records data, it validates every record
+    in one pass and returns (flags, report). flags is a Series holding a
+    bitmask per record (see nda_version_8_0.VALIDATION_FLAGS), 0 when the
+    record passed every check; report gives, per check, the number of
+    failing records and the first failing record_ID. The capacity and
+    current limits are only checked when capacity_nom is given.
+    '''
+    if type(df)!=type(pd.DataFrame()):
+        nda = nda_file.NdaFile(df, validate=False)
+        if capacity_nom is None:
+            return nda.validation
+        df = nda.records
+    flags = nda_version_8_0.validation_flags(df, capacity_nom)
+    return pd.Series(flags, index=df.index, name='flags'), nda_version_8_0.validation_report(df, flags)
+
+
+def _session(nda, table):
+    '''
+    the cycles, steps or recipes table of an NdaFile for the path passed to
+    cycle, step or recipe. NdaFile decodes lazily, so the table is read here
+    and any failure to decode the path raises the ValueError of cycle, step
+    and recipe
+    '''
+    try:
+        return getattr(nda_file.NdaFile(nda), table)
+    except Exception as e:
+        raise ValueError('Arguement pushed into the function is neither a DataFrame nor a path to an nda file') from e
+
 
 def cycle(df):  #! Function to group the data cycle-wise
     '''
@@ -93,121 +207,278 @@ def cycle(df):  #! Function to group the data cycle-wise
     it returns Cycle-wise data identical to the
     cycle sheet in the excel file of the test.
     '''
-    try:
-        if type(df) != type(pd.DataFrame()):
-            df = nda_version_8_0.nda_in_df_out(df)
-    except Exception:
-        raise ValueError('Arguement pushed into the function is neither a DataFrame nor a path to an nda file')
+    if type(df) != type(pd.DataFrame()):
+        return _session(df, 'cycles')
 
-    temp_list=[]
-    complete_list = []
-    
+    with nda_profile.stage('cycle', 'segments', len(df)):
+        segments = _segments(df)
+    with nda_profile.stage('cycle', 'table', len(segments)):
+        return _cycle_table(segments)
 
-    # df['prev_cur'] = df['current_mA'].shift(periods=1)
-    # df['prev_vol']=df['voltage_V'].shift(periods=1)
-    # df['DCIR']=-1
-    # df.loc[((df['prev_cur']==0)&(df['current_mA']!=0)),'DCIR']=abs((df['voltage_V']-df['prev_vol'])/(df['current_mA']-df['prev_cur']))*1000
-    # df.drop(columns=['prev_cur','prev_vol'],inplace=True)
-    
+
+def _runs(keys):
+    '''
+    start and end (exclusive) positions of the runs of equal values in keys,
+    or of equal rows when keys is 2-D
+    '''
+    if not len(keys):
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    changed = keys[1:] != keys[:-1]
+    if changed.ndim > 1:
+        changed = changed.any(axis=1)
+    starts = np.flatnonzero(np.r_[True, changed])
+    ends = np.r_[starts[1:], len(keys)].astype(int)
+    return starts, ends
+
+
+# Per-run aggregates that cycle and step are built from. A segment is a run
+# of consecutive records with the same step_ID, cycle and step name; segments
+# of consecutive chunks of records merge into the same aggregates, so the
+# tables can also be built while streaming (see summaries). Each field is
+# reduced with the named operation when segments are merged.
+_SEGMENT_FIELDS = {
+    'step_ID': 'first', 'cycle': 'first', 'step_name': 'first',
+    'first_time': 'first', 'last_time': 'last', 'time_in_step': 'last',
+    'first_voltage': 'first', 'last_voltage': 'last', 'max_voltage': 'max', 'min_voltage': 'min',
+    'first_current': 'first', 'last_current': 'last',
+    'capacity': 'last', 'energy': 'last', 'max_capacity': 'max', 'max_energy': 'max',
+    'DCIR': 'first', 'DCIR_sum': 'sum', 'DCIR_count': 'sum',
+}
+
+
+def _reduce_runs(values, starts, ends, how):
+    """Reduce each run [start, end) of values the way _SEGMENT_FIELDS names"""
+    if how == 'first':
+        return values[starts]
+    if how == 'last':
+        return values[ends - 1]
+    if not len(starts):
+        return values[:0]
+    reduce = {'max': np.maximum, 'min': np.minimum, 'sum': np.add}[how]
+    return reduce.reduceat(values, starts)
+
+
+def _segments(df):
+    '''
+    segments of a records frame, in record order
+    '''
+    codes = pd.factorize(df['step_name'])[0]
+    step_ids = df['step_ID'].to_numpy()
+    cycles = df['cycle'].to_numpy()
+    starts, ends = _runs(np.column_stack((step_ids, cycles, codes)))
+
+    voltage = df['voltage_V'].to_numpy()
+    current = df['current_mA'].to_numpy()
+    capacity = df['capacity_mAh'].to_numpy()
+    energy = df['energy_mWh'].to_numpy()
+    timestamp = df['timestamp'].to_numpy()
+
+    # The DCIR of the records (nda_version_8_0.dcir) is the step DCIR at
+    # the first record of a step, and its positive values are averaged per
+    # cycle
+    record_DCIR = df['DCIR'].to_numpy()
+    positive = record_DCIR > 0
+
+    columns = {
+        'step_ID': step_ids,
+        'cycle': cycles,
+        'step_name': df['step_name'].to_numpy(),
+        'first_time': timestamp,
+        'last_time': timestamp,
+        'time_in_step': df['time_in_step'].to_numpy(),
+        'first_voltage': voltage,
+        'last_voltage': voltage,
+        'max_voltage': voltage,
+        'min_voltage': voltage,
+        'first_current': current,
+        'last_current': current,
+        'capacity': capacity,
+        'energy': energy,
+        'max_capacity': capacity,
+        'max_energy': energy,
+        'DCIR_sum': np.where(positive, record_DCIR, 0).astype(np.float64),
+        'DCIR_count': positive.astype(np.int64),
+    }
+    segments = {field: _reduce_runs(values, starts, ends, _SEGMENT_FIELDS[field])
+                for field, values in columns.items()}
+    segments['DCIR'] = record_DCIR[starts].astype(np.float32)
+    return pd.DataFrame(segments, columns=list(_SEGMENT_FIELDS))
+
+
+def _group_segments(segments, keys, fields):
+    '''
+    reduces the segments over the runs of equal keys (a list of columns),
+    after a stable sort on the first key if it is not already sorted
+    '''
+    if not segments[keys[0]].is_monotonic_increasing:
+        segments = segments.iloc[np.argsort(segments[keys[0]].to_numpy(), kind='stable')]
+    starts, ends = _runs(np.column_stack([segments[key].to_numpy() for key in keys]))
+    return {field: _reduce_runs(segments[field].to_numpy(), starts, ends, _SEGMENT_FIELDS[field])
+            for field in fields}
+
+
+def _merge_segments(frames):
+    '''
+    segments of consecutive chunks of records, joined into the segments of
+    the whole records frame
+    '''
+    if not frames:
+        return pd.DataFrame(columns=list(_SEGMENT_FIELDS))
+    segments = pd.concat(frames, ignore_index=True)
+    if not len(segments):
+        return segments
+    starts, ends = _runs(segments[['step_ID', 'cycle', 'step_name']].to_numpy())
+    return pd.DataFrame({field: _reduce_runs(segments[field].to_numpy(), starts, ends, how)
+                         for field, how in _SEGMENT_FIELDS.items()})
+
+
+def _cycle_table(segments):
+    '''
+    the cycle table of cycle, built from segments
+    '''
     chg_temp = 'CCCV_Chg' #default values
     dchg_temp = "CC_Dchg"    
-    step_col=list(df['step_name'].unique()[1:])
+    step_col=list(pd.unique(segments['step_name'])[1:])
     for col in step_col:
         if re.search('chg',col,re.IGNORECASE):
             chg_temp=col
         if re.search('dchg',col,re.IGNORECASE):
             dchg_temp=col                           
 
+    cycles = _group_segments(segments, ['cycle'], ['cycle', 'first_time', 'last_time', 'DCIR_sum', 'DCIR_count'])
+    index = cycles['cycle']
+    chg = _cycle_step_summary(segments, chg_temp, index)
+    dchg = _cycle_step_summary(segments, dchg_temp, index)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        DCIR_avg = cycles['DCIR_sum'] / cycles['DCIR_count']
+
+    df3=pd.DataFrame({
+        'Cycle Index': index.astype(np.int64),
+        'Onset Date': cycles['first_time'],
+        'End Date': cycles['last_time'],
+        'Chg. Cap.(Ah)': chg['capacity'],
+        'DChg. Cap.(Ah)': dchg['capacity'],
+        'Chg. Energy(Wh)': chg['energy'],
+        'DChg. Energy_(Wh)': dchg['energy'],
+        'Chg_Time(hh:mm:ss)': chg['time'],
+        'DChg_Time(hh:mm:ss)': dchg['time'],
+        'Chg_Onset_Volt_(V)': chg['onset_volt'],
+        'DChg_Oneset_Volt_(V)': dchg['onset_volt'],
+        'End_of_Chg_Volt_(V)': chg['end_volt'],
+        'End_of_DChg_Volt_(V)': dchg['end_volt'],
+        'Chg_Oneset_Current_(A)': chg['onset_current'],
+        'DChg_Oneset_Curent_(A)': dchg['onset_current'],
+        'End_of_Chg_Current_(A)': chg['end_current'],
+        'End_of_DChg_Current_(A)': dchg['end_current'],
+        'DCIR(mΩ)': DCIR_avg.astype(np.float32),
+    })
+    return df3
 
-    for i in range(min(df['cycle']),max(df['cycle']+1)):                         
-        # df2=df.groupby('cycle').get_group(i)
-
-        df2 = df[df['cycle']==i]
-        cycle=i                                                                                                                                                                           
-
-        starting_date=list(df2['timestamp'])[0]
-        end_date=list(df2['timestamp'])[-1]
-        
-        df_chg=df2[(df2['step_name']==chg_temp)]
-        df_dchg=df2[(df2['step_name']==dchg_temp)]
-
-        charging_capacity=max(df_chg['capacity_mAh'],default=-1)
-        discharging_capacity=max(df_dchg['capacity_mAh'],default=-1)
-
-        charging_energy=max(df_chg['energy_mWh'],default=-1)
-        discharging_energy=max(df_dchg['energy_mWh'],default=-1)
-
-        chg_starting_volt=list(df_chg['voltage_V'])[0]
-        chg_ending_volt=list(df_chg['voltage_V'])[-1]
-        dchg_starting_volt=list(df_dchg['voltage_V'])[0]
-        dchg_ending_volt=list(df_dchg['voltage_V'])[-1]
 
-        chg_starting_current=list(df_chg['current_mA'])[0]
-        chg_ending_current=list(df_chg['current_mA'])[-1]
-        dchg_starting_current=list(df_dchg['current_mA'])[0]
-        dchg_ending_current=list(df_dchg['current_mA'])[-1]
+def _cycle_step_summary(segments, step_name, index):
+    '''
+    capacity, energy, time and onset/end voltage and current per cycle over
+    the segments of one step type, aligned to the cycle numbers in index.
+    Cycles without such a step get -1 capacity and energy (as before), NaT
+    time and NaN voltages and currents.
+    '''
+    sub = segments[(segments['step_name'] == step_name).to_numpy()]
+    runs = _group_segments(sub, ['cycle'], ['cycle', 'max_capacity', 'max_energy', 'first_voltage',
+                                            'last_voltage', 'first_current', 'last_current', 'time_in_step'])
+    pos = np.searchsorted(index, runs['cycle'])
+
+    summary = {}
+    for key, field, default in [('capacity', 'max_capacity', -1),
+                                ('energy', 'max_energy', -1),
+                                ('onset_volt', 'first_voltage', np.nan),
+                                ('end_volt', 'last_voltage', np.nan),
+                                ('onset_current', 'first_current', np.nan),
+                                ('end_current', 'last_current', np.nan),
+                                ('time', 'time_in_step', np.nan)]:
+        out = np.full(len(index), default, dtype=np.float64)
+        out[pos] = runs[field]
+        summary[key] = out
+    summary['time'] = pd.to_timedelta(summary['time'], unit='s').to_numpy()
+    return summary
+
+
+def _step_table(segments):
+    '''
+    the step table of step, built from segments
+    '''
+    steps = _group_segments(segments, ['step_ID'], list(_SEGMENT_FIELDS))
 
-        charging_time=timedelta(seconds=list(df_chg['time_in_step'])[-1])
-        discharging_time=timedelta(seconds=list(df_dchg['time_in_step'])[-1])
+    col_list = ['Cycle Index',
+                'Step Number',
+                'Step Type',
+                'Step Time',
+                'Oneset Date',
+                'End Date',
+                'Capacity(Ah)',
+                'Energy(Wh)',
+                'Oneset Volt.(V)',
+                'End Volt.(V)',
+                'Starting current(A)',
+                'Termination current(A)',
+                'Max Volt.(V)',
+                'Min Volt(V)',
+                'DCIR(mΩ)']
 
-        dcir_cyl=df2.loc[df2['DCIR']>0,'DCIR']
-    
-        DCIR_avg=dcir_cyl.mean()     
-
-        temp_list=[
-                    cycle,
-                    starting_date,
-                    end_date,
-                    charging_capacity,
-                    discharging_capacity,
-                    charging_energy,
-                    discharging_energy,
-                    charging_time,
-                    discharging_time,
-                    chg_starting_volt,
-                    dchg_starting_volt,
-                    chg_ending_volt,
-                    dchg_ending_volt,
-                    chg_starting_current,
-                    dchg_starting_current,
-                    chg_ending_current,
-                    dchg_ending_current,
-                    DCIR_avg
-                    ]
-        
-        complete_list.append(temp_list)
-    df3=pd.DataFrame(complete_list,columns=['Cycle Index','Onset Date','End Date','Chg. Cap.(Ah)','DChg. Cap.(Ah)',
-                                                    'Chg. Energy(Wh)','DChg. Energy_(Wh)','Chg_Time(hh:mm:ss)','DChg_Time(hh:mm:ss)','Chg_Onset_Volt_(V)',
-                                                    'DChg_Oneset_Volt_(V)','End_of_Chg_Volt_(V)','End_of_DChg_Volt_(V)','Chg_Oneset_Current_(A)','DChg_Oneset_Curent_(A)',
-                                                    'End_of_Chg_Current_(A)','End_of_DChg_Current_(A)','DCIR(mΩ)'])
-    return df3
+    return pd.DataFrame(dict(zip(col_list, [
+        steps['cycle'].astype(np.int64),
+        steps['step_ID'].astype(np.int64),
+        steps['step_name'],
+        [str(timedelta(seconds=int(t))) for t in steps['time_in_step']],
+        steps['first_time'],
+        steps['last_time'],
+        steps['capacity'].astype(np.float64) / 1000,
+        steps['energy'].astype(np.float64) / 1000,
+        steps['first_voltage'].astype(np.float64),
+        steps['last_voltage'].astype(np.float64),
+        steps['first_current'].astype(np.float64) / 1000,
+        steps['last_current'].astype(np.float64) / 1000,
+        steps['max_voltage'].astype(np.float64),
+        steps['min_voltage'].astype(np.float64),
+        steps['DCIR'],
+    ])))
+
+
+def summaries(nda, chunk_size=1000000):
+    '''
+    returns (cycles, steps) for the nda file: the same tables as cycle and
+    step, aggregated in one pass while the records are decoded chunk_size
+    at a time, so the full records are never held in memory. Memory grows
+    with the number of steps rather than the number of records.
+    '''
+    if (nda.split('.')[-1] != 'nda'):
+        raise ValueError("File passed in function is not an nda file")
+    frames = [_segments(df) for df, _ in nda_version_8_0.iter_records(nda, chunk_size)]
+    segments = _merge_segments(frames)
+    return _cycle_table(segments), _step_table(segments)
 
 
 def _validator_step(df) :   
 
-    for id,i in df.iterrows():
-        if(pd.to_datetime(i['End Date'])>pd.to_datetime(i['Onset Date'])):
-            raise ValueError('Date error with cycle number '+str(i['Cycle_Index']))
-        if(i["Cycle_Index"]<1):
-            raise ValueError('Cycle Index out of range; please check data.')
-        if(i['Chg_Onset_Volt_(V)']<1.5 or i['DChg_Onset_Volt_(V)']<1.5):
-            raise ValueError('Voltage value too low in cycle number '+str(i['Cycle_Index']))
-        if(i['DCIR(mΩ)']<0):
-            raise ValueError('DCIR is negative in cycle number '+str(i['Cycle_Index']))
-        # if
+    _raise_first_failure(df, 'Cycle_Index', [
+        (pd.to_datetime(df['End Date']) > pd.to_datetime(df['Onset Date']), 'Date error with cycle number {}'),
+        (df['Cycle_Index'] < 1, 'Cycle Index out of range; please check data.'),
+        ((df['Chg_Onset_Volt_(V)'] < 1.5) | (df['DChg_Onset_Volt_(V)'] < 1.5), 'Voltage value too low in cycle number {}'),
+        (df['DCIR(mΩ)'] < 0, 'DCIR is negative in cycle number {}'),
+    ])
 
 
-def step(df):  #! Function to group the data step-wise
+def step(df, steps=None):  #! Function to group the data step-wise
     '''
     When passed an nda file or the records data,
     it returns Step-wise data identical to the
     cycle sheet in the excel file of the test.
+    Use steps to get only those Step Numbers; for an nda file only their
+    records are read, through the sidecar index
     '''
-    try:
-        if type(df)!=type(pd.DataFrame()):
-            df=nda_version_8_0.nda_in_df_out(df)
-    except:
-        raise ValueError('Arguement pushed into the function is neither a DataFrame nor a path to an nda file')
+    if steps is not None:
+        return _select_steps(df, steps)
+    if type(df)!=type(pd.DataFrame()):
+        return _session(df, 'steps')
     # print(df)
     # df['current_mA']=df['current_mA'].div(1000)
     # df['capacity_mAh']=df['capacity_mAh'].div(1000)
@@ -215,259 +486,106 @@ def step(df):  #! Function to group the data step-wise
     rec_columns = [
     'record_ID', 'cycle' ,'step_ID','step_name', 'time_in_step', 'voltage_V',
     'current_mA', 'capacity_mAh','energy_mWh','timestamp','Validated','DCIR']
-    if(list(df.keys())!=rec_columns):
+    # Temperature columns are not used
+    keys = [c for c in df.keys() if not re.match(r'T\d+$', str(c))]
+    if(keys not in (rec_columns, [c if c != 'Validated' else 'ID_flags' for c in rec_columns],
+                    [c for c in rec_columns if c != 'Validated'])):
         raise ValueError ('DataFrame passed ')
         
     
     
-    df['prev_cur']=df['current_mA'].shift(periods=1)
-    df['prev_vol']=df['voltage_V'].shift(periods=1)
-    df['prev_step']=df['step_ID'].shift(periods=1)
-
-
-    df['DCIR']=-1
-    df.loc[((df['prev_cur']==0)&(df['current_mA']!=0)&(df['prev_step']!=df['step_ID'])),'DCIR']=abs((df['voltage_V']-df['prev_vol'])/(df['current_mA']-df['prev_cur']))*1000
-    df.drop(columns=['prev_cur','prev_vol','prev_step'],inplace=True)
-
-    temp_list=[]
-    complete_list=[]
-
-    for i in range(min(df['step_ID']),max(df['step_ID'])+1):
-        # print(i)
-        # df2=df.groupby('step_ID').get_group(i)
-        df2=df[df['step_ID']==i]
-        DCIR=list(df2['DCIR'])[0]
-        Starting_Volt=list(df2['voltage_V'])[0]
-        End_Voltage=list(df2['voltage_V'])[-1]
-        Starting_current=list(df2['current_mA'])[0]
-        End_Current=list(df2['current_mA'])[-1]
-        Capacity=list(df2['capacity_mAh'])[-1]
-        Energy=list(df2['energy_mWh'])[-1]
-        Starting_Date=list(df2['timestamp'])[0]
-        End_Date=list(df2['timestamp'])[-1]
-        Step_Time=timedelta(seconds=list(df2['time_in_step'])[-1])
-        step_ID=i
-        Maximum_voltage=max(list(df2['voltage_V']))
-        Minimum_voltage=min(list(df2['voltage_V']))
-        Step_Type=list(df2['step_name'])[0]
-        Cycle_Index=list(df2['cycle'])[0]
-
-        temp_list= [
-            Cycle_Index,
-            step_ID,
-            Step_Type,
-            str(Step_Time),
-            Starting_Date,
-            End_Date,
-            Capacity/1000,
-            Energy/1000,
-            Starting_Volt,
-            End_Voltage,
-            Starting_current/1000,
-            End_Current/1000,
-            Maximum_voltage,
-            Minimum_voltage,
-            DCIR,
-        ]
-        complete_list.append(temp_list)
-        
-    col_list = ['Cycle Index',
-                'Step Number',
-                'Step Type',
-                'Step Time',
-                'Oneset Date',
-                'End Date',
-                'Capacity(Ah)',
-                'Energy(Wh)',
-                'Oneset Volt.(V)',
-                'End Volt.(V)',
-                'Starting current(A)',
-                'Termination current(A)',
-                'Max Volt.(V)',
-                'Min Volt(V)',
-                'DCIR(mΩ)']
-
-    df=pd.DataFrame(complete_list,columns=col_list)
-
-    dict_dtypes={
-        'Step_Number':np.int64,
-        'Step_Type':object,
-        'Capacity(Ah)':np.float64,
-        'Energy(Wh)':np.float64,
-        'Starting_Voltage(V)':np.float64,
-        'End_Voltage(V)':np.float64,
-        'DCIR':np.float64,
-        'Starting_current(A)':np.float64,
-        'End_Current(A)':np.float64,
-        'Maximum_voltage(V)':np.float64,
-        'Minimum_voltage(V)':np.float64
-    }
+    with nda_profile.stage('step', 'segments', len(df)):
+        segments = _segments(df)
+    with nda_profile.stage('step', 'table', len(segments)):
+        return _step_table(segments)
 
-    # df=df.astype(dict_dtypes)
 
-    return df
+def _select_steps(df, steps):
+    '''
+    rows of step(df) for the given Step Numbers, keeping their index in the
+    full step table
+    '''
+    steps = list(steps)
+    if type(df)==type(pd.DataFrame()):
+        summary = step(df)
+        return summary[summary['Step Number'].isin(steps)]
+    if (df.split('.')[-1] != 'nda'):
+        raise ValueError("File passed in function is not an nda file")
+    # The DCIR of the first record of each run is already worked out
+    # against the record before the run
+    summary = pd.concat([step(frame) for frame in nda_index.read_runs(df, 'steps', steps, aux=False)])
+    summary.index = summary['Step Number'].to_numpy() - 1
+    return summary
 
 # Function to find distinct-recipes
 
 def recipe(df):
-
-    try:
-        if type(df)!=type(pd.DataFrame()):
-            df=nda_version_8_0.nda_in_df_out(df)
-    except:
-        raise ValueError('Arguement pushed into the function is neither a DataFrame nor a path to an nda file')
-    
-    dict_voltage={}
-    dict_recipe={}
-    dict_rest={}
-    dict_current={}
-    dict_step={}
-    dict_cycle={}
-    recipe_cycle=[]
-    dict_stepid={}
-    dict_cutoff_curr={}
-    dict_cutoff_vol={}
-    chg_temp = ''
-    dchg_temp = ''
-    step_col=list(df['step_name'].unique()[1:])
-    for col in step_col:
-        if re.search('_chg',col,re.IGNORECASE):
-            chg_temp=col
-        if re.search('_dchg',col,re.IGNORECASE):
-            dchg_temp=col       
-
-    for i in range(min(df['cycle']),max(df['cycle'])):
-        #For non-validated files
-        #if(i==7):
-            #continue
-        # df2=df.groupby('cycle').get_group(i)
-        df2=df[df['cycle']==i]
-        recipe_cycle.append(i)
-        dict_recipe[i]=[]
-        dict_rest[i]=[]
-        dict_voltage[i]=[]
-        dict_current[i]=[]
-        dict_step[i]=[]
-        dict_cycle[i]=[]
-        dict_stepid[i]=[]
-        dict_cutoff_curr[i]=[]
-        dict_cutoff_vol[i]=[]
-        for j in range(min(df2['step_ID']),max(df2['step_ID'])+1):
-            df3=df2[df2['step_ID']==j]
-            dict_recipe[i].append(df3['step_name'].iloc[0])
-
-            dict_step[i].append(j)
-
-            dict_cycle[i].append(i)
-
-            dict_stepid[i].append(j)
-
-            if(df3['step_name'].iloc[0]=='Rest'):
-                dict_rest[i].append(str(timedelta(seconds=list(df3['time_in_step'])[-1])))
-            else:
-                dict_rest[i].append(np.nan)
-
-            if(df3['step_name'].iloc[0]==chg_temp):
-                dict_voltage[i].append(round(df3['voltage_V'].max(),2))
-                dict_cutoff_vol[i].append(np.nan)
-            elif(df3['step_name'].iloc[0]==dchg_temp):
-                dict_voltage[i].append(round(df3['voltage_V'].min(),2))
-                dict_cutoff_vol[i].append(round(list(df3['voltage_V'])[-1],2))
-            else:
-                dict_voltage[i].append(np.nan)
-                dict_cutoff_vol[i].append(np.nan)
-
-
-            if(df3['step_name'].iloc[0]==chg_temp):
-                dict_current[i].append(round(df3['current_mA'].iloc[0]/1000,2))
-                dict_cutoff_curr[i].append(round(list(df3['current_mA'])[-1]/1000,2))
-            elif(df3['step_name'].iloc[0]==dchg_temp):
-                dict_current[i].append(round(df3['current_mA'].iloc[0]/1000,2))
-                dict_cutoff_curr[i].append(np.nan)
-            else:
-                dict_current[i].append(np.nan)
-                dict_cutoff_curr[i].append(np.nan) 
-
-    recipe=[]
-    rest=[]
-    voltage=[]
-    current=[]
-    cycle=[]
-    stepid=[]
-    cutoff_curr=[]
-    cutoff_vol=[]
-
-    for i in recipe_cycle:
-        for j in range(len(dict_recipe[i])):
-            recipe.append(dict_recipe[i][j])
-            rest.append(dict_rest[i][j])
-            voltage.append(dict_voltage[i][j])
-            current.append(dict_current[i][j])
-            cycle.append(dict_cycle[i][j])
-            stepid.append(dict_stepid[i][j])  
-            cutoff_curr.append(dict_cutoff_curr[i][j])
-            cutoff_vol.append(dict_cutoff_vol[i][j])                     
-
-    df_recipe=pd.DataFrame(zip(np.array(stepid).reshape(-1,1),
-                           np.array(cycle).reshape(-1,1),
-                           np.array(recipe).reshape(-1,1),
-                           np.array(voltage).reshape(-1,1),
-                           np.array(current).reshape(-1,1),
-                           np.array(rest).reshape(-1,1),
-                           np.array(cutoff_curr).reshape(-1,1),
-                           np.array(cutoff_vol).reshape(-1,1)),columns=['Step_Id','Cycle','Step_Name','Voltage','Current','Rest','Cutoff_current','Cutoff_voltage'])                      
+    '''
+    When passed an nda file or the records data, it finds the distinct
+    recipes (sequences of steps with their setpoints) run in the test.
+    Returns (recipes, recipe_cycles): recipes maps 'Recipe-1', 'Recipe-2', ...
+    (numbered in order of first appearance) to the step table of that recipe
+    and recipe_cycles maps the same names to the list of cycles that ran it.
+    The last cycle, which may still be running, is left out.
+    '''
+    if type(df)!=type(pd.DataFrame()):
+        return _session(df, 'recipes')
     
-    for col in df_recipe.columns:
-        df_recipe[col]=df_recipe[col].apply(lambda x : x[0]) 
-        
-    df_recipe.replace(np.nan,r' ',regex=True,inplace=True)
-    df_recipe.replace(r'nan',r' ',regex=True,inplace=True)
-
-    recipe_unmatch=[1]
-    for i in range(len(recipe_cycle)-1):
-        
-        df_temp1=df_recipe[df_recipe['Cycle']==recipe_cycle[i]]
-        
-        df_temp2=df_recipe[df_recipe['Cycle']==recipe_cycle[i+1]]
-        df_temp1=df_temp1.drop(['Cycle','Step_Id'],axis=1)
-        df_temp2=df_temp2.drop(['Cycle','Step_Id'],axis=1)
-        if(df_temp1.reset_index(drop=True).equals(df_temp2.reset_index(drop=True))):
-            continue
+    with nda_profile.stage('recipe', 'setpoints', len(df)):
+        chg_temp = ''
+        dchg_temp = ''
+        step_col=list(df['step_name'].unique()[1:])
+        for col in step_col:
+            if re.search('_chg',col,re.IGNORECASE):
+                chg_temp=col
+            if re.search('_dchg',col,re.IGNORECASE):
+                dchg_temp=col       
+
+        df = df[(df['cycle'] < df['cycle'].max()).to_numpy()]
+        if not df['step_ID'].is_monotonic_increasing:
+            df = df.iloc[np.argsort(df['step_ID'].to_numpy(), kind='stable')]
+
+        # Setpoints of every step, from the step boundaries
+        starts, ends = _runs(df['step_ID'].to_numpy())
+        last = ends - 1
+        voltage = df['voltage_V'].to_numpy()
+        current = df['current_mA'].to_numpy()
+        step_cycle = df['cycle'].to_numpy()[starts]
+        step_name = df['step_name'].to_numpy()[starts]
+        is_chg = step_name == chg_temp
+        is_dchg = step_name == dchg_temp
+        if len(starts):
+            max_volt = np.maximum.reduceat(voltage, starts)
+            min_volt = np.minimum.reduceat(voltage, starts)
         else:
-            recipe_unmatch.append(recipe_cycle[i]) 
-    recipe_unmatch.append(df_recipe['Cycle'].max())           
-    recipe_unmatch=sorted(list(set(recipe_unmatch)))
-
-    dict={}
-    for i in range(len(recipe_unmatch)-1):
-        dict[recipe_unmatch[i]]=[]
-        #df1=df_recipe.groupby('Cycle').get_group(recipe_unmatch[i]).reset_index(drop=True)
-        df1=df_recipe[df_recipe['Cycle']==recipe_unmatch[i]].reset_index(drop=True)
-        df1=df1.drop(['Cycle','Step_Id'],axis=1)
-        for j in range(i+1,len(recipe_unmatch)):
-            #df2=df_recipe.groupby('Cycle').get_group(recipe_unmatch[j]).reset_index(drop=True)
-            df2=df_recipe[df_recipe['Cycle']==recipe_unmatch[j]].reset_index(drop=True)
-            df2=df2.drop(['Cycle','Step_Id'],axis=1)
-            if(df1.equals(df2)):
-                dict[recipe_unmatch[i]].append(recipe_unmatch[j]) 
-
-    for i in dict:
-        for j in dict[i]:
-            if j in recipe_unmatch:
-                recipe_unmatch.remove(j)
-           
-    arr=[]
-    dict_={}
-    k=0
-    print(recipe_unmatch)
-    for i in range(len(recipe_unmatch)):
-        k+=1   
-        # df_temp=df_recipe.groupby('Cycle').get_group(recipe_unmatch[i])
-        df_temp=df_recipe[df_recipe['Cycle']==recipe_unmatch[i]]
-        
-        df_temp=df_temp.drop(['Cycle','Step_Id'],axis=1).reset_index(drop=True)
-        arr.append(df_temp)
-        print('Recipe-{k}'.format(k=k))
-        dict_['Recipe-{k}'.format(k=k)]=df_temp
-        displayhook(df_temp)
-       
+            max_volt = min_volt = np.empty(0, dtype=voltage.dtype)
+
+        steps = pd.DataFrame({
+            'Step_Name': step_name,
+            'Voltage': np.where(is_chg, np.round(max_volt, 2), np.where(is_dchg, np.round(min_volt, 2), np.nan)),
+            'Current': np.where(is_chg | is_dchg, np.round(current[starts] / 1000, 2), np.nan),
+            'Rest': [str(timedelta(seconds=int(t))) if name == 'Rest' else None
+                     for name, t in zip(step_name, df['time_in_step'].to_numpy()[last])],
+            'Cutoff_current': np.where(is_chg, np.round(current[last] / 1000, 2), np.nan),
+            'Cutoff_voltage': np.where(is_dchg, np.round(voltage[last], 2), np.nan),
+        })
+
+    with nda_profile.stage('recipe', 'signatures', len(steps)):
+        # A cycle's signature is the hash of its step table: each step row is
+        # hashed together with its position in the cycle and the row hashes of a
+        # cycle are summed. Cycles with equal signatures ran the same recipe.
+        cycle_starts, cycle_ends = _runs(step_cycle)
+        position = np.arange(len(steps)) - np.repeat(cycle_starts, cycle_ends - cycle_starts)
+        row_hash = pd.util.hash_pandas_object(steps.assign(position=position), index=False).to_numpy()
+        signature = np.add.reduceat(row_hash, cycle_starts) if len(cycle_starts) else row_hash
+        codes, _ = pd.factorize(signature)
+        cycles = step_cycle[cycle_starts]
+
+    recipes = {}
+    recipe_cycles = {}
+    first = np.unique(codes, return_index=True)[1]
+    for k, i in enumerate(first):
+        name = 'Recipe-{k}'.format(k=k+1)
+        recipes[name] = steps.iloc[cycle_starts[i]:cycle_ends[i]].reset_index(drop=True)
+        recipe_cycles[name] = [int(c) for c in cycles[codes == k]]
+    return recipes, recipe_cycles
@@ -0,0 +1,188 @@
+# Sidecar index of the cycles and steps of an nda file, for random access
+
+import os
+import tempfile
+import zipfile
+import numpy as np
+import pandas as pd
+from . import nda_version_8_0
+
+# Bump whenever the index layout changes, so stale sidecars are rebuilt
+INDEX_VERSION = 1
+
+# Fields of a row of the cycle and step tables. Every row is one run of kept
+# records sharing a cycle (or step_ID): its key, its first and end row in the
+# records frame, the 86 byte slots after the header offset it spans (up to
+# the first slot of the next run, so the aux records of its last record are
+# included) and the slot and renumbered IDs of the kept record before it.
+RUN_FIELDS = ['key', 'first_row', 'end_row', 'first_slot', 'end_slot',
+              'prev_slot', 'prev_record_ID', 'prev_step_ID']
+
+# Fields of the meta array of an index
+META_FIELDS = ['version', 'size', 'mtime_ns', 'offset', 'slots', 'rows']
+
+# Indexes that could not be written next to their nda file
+_memory = {}
+
+
+def sidecar_path(nda):
+    '''
+    Location of the index of an nda file: next to it, with .idx.npz appended.
+    '''
+    return nda + '.idx.npz'
+
+
+def _runs(keys, main, record_ID, step_ID, slots):
+    """Table of the runs of equal keys among the kept records (see RUN_FIELDS)"""
+    changed = np.ones(len(keys), dtype=bool)
+    changed[1:] = keys[1:] != keys[:-1]
+    first = np.flatnonzero(changed)
+    end = np.append(first[1:], len(keys))
+    first_slot = main[first]
+    end_slot = np.append(first_slot[1:], slots)
+    prev = (first - 1).clip(0)
+    has_prev = first > 0
+    return np.column_stack([
+        keys[first], first, end, first_slot, end_slot,
+        np.where(has_prev, main[prev], -1),
+        np.where(has_prev, record_ID[prev], 0),
+        np.where(has_prev, step_ID[prev], 0),
+    ]).astype(np.int64).reshape(-1, len(RUN_FIELDS))
+
+
+def build_index(nda):
+    '''
+    Builds the index of an nda file in one scan over its record region:
+    the header offset, the slots and rows of every cycle and step, the
+    duplicated records dropped by the decoder and the aux channels.
+    '''
+    st = os.stat(nda)
+    offset = nda_version_8_0.record_offset(nda)
+    recs = nda_version_8_0._map_records(nda, offset)
+    main, record_ID, step_ID, dropped = nda_version_8_0._kept_records(nda, recs)
+    _, aux_rows = nda_version_8_0._record_rows(recs)
+    cycle = recs['cycle'][main].astype(np.int64) + 1
+    return {
+        'meta': np.array([INDEX_VERSION, st.st_size, st.st_mtime_ns, offset, len(recs), len(main)], dtype=np.int64),
+        'cycles': _runs(cycle, main, record_ID, step_ID, len(recs)),
+        'steps': _runs(step_ID, main, record_ID, step_ID, len(recs)),
+        'dropped': dropped.astype(np.int64),
+        'channels': np.unique(recs['aux'][aux_rows]).astype(np.int64),
+    }
+
+
+def _current(index, st):
+    meta = dict(zip(META_FIELDS, index['meta']))
+    return meta['version'] == INDEX_VERSION and meta['size'] == st.st_size and meta['mtime_ns'] == st.st_mtime_ns
+
+
+def _save(nda, index):
+    """Write the sidecar atomically; returns False when its directory is not writable"""
+    path = sidecar_path(nda)
+    try:
+        fd, tmp = tempfile.mkstemp(prefix='.idx-', dir=os.path.dirname(os.path.abspath(path)))
+    except OSError:
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **index)
+        os.replace(tmp, path)
+        return True
+    except OSError:
+        os.unlink(tmp)
+        return False
+
+
+def load_index(nda):
+    '''
+    Returns the index of an nda file, read from its sidecar when the file's
+    size and modification time still match it, otherwise rebuilt and saved.
+    '''
+    st = os.stat(nda)
+    key = os.path.abspath(nda)
+    index = _memory.get(key)
+    if index is None:
+        try:
+            with np.load(sidecar_path(nda)) as f:
+                index = {name: f[name] for name in f.files}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            index = None
+    if index is not None and _current(index, st):
+        return index
+
+    index = build_index(nda)
+    if _save(nda, index):
+        _memory.pop(key, None)
+    else:
+        _memory[key] = index
+    return index
+
+
+def read_runs(nda, table, keys, columns=None, time_range=None, validate=True, aux=True, compact=False):
+    '''
+    Decodes the records of the runs of table ('cycles' or 'steps') whose key
+    is in keys, seeking straight to them through the index. Returns one
+    records frame per run, equal to the same rows of the full records
+    (index included). time_range=(start, end) keeps only the records with
+    start <= timestamp < end. When no run matches a single empty frame is
+    returned.
+    '''
+    index = load_index(nda)
+    meta = dict(zip(META_FIELDS, index['meta']))
+    runs = index[table]
+    runs = runs[np.isin(runs[:, 0], np.asarray(list(keys), dtype=np.int64))]
+    recs = nda_version_8_0._map_records(nda, int(meta['offset']))
+    drop_early_steps = nda_version_8_0.get_barcode(nda).startswith('0AD')
+    columns = nda_version_8_0._output_columns(columns, validate, index['channels'] if aux else [])
+    with_aux = any(nda_version_8_0._AUX_COLUMN_RE.match(col) for col in columns)
+
+    frames = []
+    for _, first_row, end_row, first_slot, end_slot, prev_slot, prev_record_ID, prev_step_ID in runs:
+        view = recs[first_slot:end_slot]
+        main, aux_rows = nda_version_8_0._record_rows(view)
+        rows = main + first_slot
+        rows = rows[~np.isin(rows, index['dropped'])]
+        if drop_early_steps:
+            rows = rows[recs['step'][rows] >= 7]
+
+        last = end_row == meta['rows']
+        record_carry = step_carry = None
+        if prev_slot >= 0:
+            record_carry = (recs['index'][prev_slot], prev_record_ID)
+            step_carry = (recs['step'][prev_slot], prev_step_ID)
+        record_ID = nda_version_8_0._renumber(recs['index'][rows].astype(np.int64), record_carry, last)[0]
+        step_ID = nda_version_8_0._renumber(recs['step'][rows].astype(np.int64), step_carry, last)[0]
+        prev_rows = np.append(prev_slot, rows[:-1])
+        prev_step_IDs = np.append(prev_step_ID, step_ID[:-1])
+        labels = np.arange(first_row, end_row)
+
+        if time_range is not None:
+            start, end = time_range
+            timestamp = nda_version_8_0._decode_timestamps(recs, rows)
+            inside = np.ones(len(rows), dtype=bool)
+            if start is not None:
+                inside &= timestamp >= pd.Timestamp(start).to_datetime64()
+            if end is not None:
+                inside &= timestamp < pd.Timestamp(end).to_datetime64()
+            rows, prev_rows, record_ID, step_ID, prev_step_IDs, labels = (
+                a[inside] for a in (rows, prev_rows, record_ID, step_ID, prev_step_IDs, labels))
+
+        block = None
+        if with_aux:
+            aux_df = pd.DataFrame(nda_version_8_0._decode_aux(view, aux_rows), columns=nda_version_8_0.aux_columns)
+            block = nda_version_8_0.aux_block(aux_df.drop_duplicates())
+        frames.append(nda_version_8_0._assemble(recs, rows, prev_rows, record_ID, step_ID, prev_step_IDs,
+                                                labels, columns, validate, compact, block))
+    if not frames:
+        empty = np.empty(0, dtype=np.int64)
+        frames.append(nda_version_8_0._assemble(recs, empty, empty, empty, empty, empty, empty,
+                                                columns, validate, compact, None))
+    return frames
+
+
+def read_cycles(nda, cycles, columns=None, time_range=None, validate=True, aux=True, compact=False):
+    '''
+    Records of the given cycles of an nda file, read through the index
+    without decoding the rest of the file.
+    '''
+    return pd.concat(read_runs(nda, 'cycles', cycles, columns, time_range, validate, aux, compact))
@@ -0,0 +1,107 @@
+# Per-stage metrics of the decoders, for finding where the time of a slow file goes
+
+import contextlib
+import time
+import tracemalloc
+from collections import namedtuple
+
+# One timed stage: the function it ran in (e.g. 'nda_in_df_out'), the stage
+# name, its wall time, the records it processed and bytes it scanned (None
+# where that does not apply) and, when memory is traced, the bytes it left
+# allocated and its peak allocation above what was in use when it started.
+StageMetric = namedtuple('StageMetric', ['function', 'stage', 'seconds', 'records', 'bytes',
+                                         'allocated', 'peak'])
+
+# Callbacks of the active profile blocks; stages are only timed while one is set
+_callbacks = []
+
+
+class _Stage:
+    """A stage being timed; records and bytes can be set while it runs"""
+
+    def __init__(self, function, name, records, nbytes):
+        self.function = function
+        self.name = name
+        self.records = records
+        self.bytes = nbytes
+
+    def __enter__(self):
+        self._memory = None
+        if tracemalloc.is_tracing():
+            self._memory = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        allocated = peak = None
+        if self._memory is not None and tracemalloc.is_tracing():
+            current, traced_peak = tracemalloc.get_traced_memory()
+            allocated = current - self._memory
+            if hasattr(tracemalloc, 'reset_peak'):
+                peak = traced_peak - self._memory
+        metric = StageMetric(self.function, self.name, seconds, self.records, self.bytes, allocated, peak)
+        for callback in list(_callbacks):
+            callback(metric)
+
+
+class _NullStage:
+    """Stand-in returned while nothing is profiling: enters, exits and ignores every setting"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(function, name, records=None, bytes=None):
+    '''
+    Context manager timing one stage of function, reported to every active
+    profile block when it exits. records and bytes can also be set on the
+    returned object inside the block, once they are known. When no profile
+    block is active this returns a shared no-op object, so instrumented code
+    costs one function call per stage.
+    '''
+    if not _callbacks:
+        return _NULL_STAGE
+    return _Stage(function, name, records, bytes)
+
+
+@contextlib.contextmanager
+def profile(callback=None, memory=False):
+    '''
+    Collects a StageMetric for every stage of nda_in_df_out, cycle, step and
+    recipe run inside the with block and yields the list they are appended
+    to. callback, when given, is also called with each metric as its stage
+    finishes, e.g. to export it to a metrics system. With memory the block
+    traces allocations with tracemalloc (which slows decoding down) and the
+    metrics include the bytes allocated by each stage.
+    '''
+    metrics = []
+
+    def collect(metric):
+        metrics.append(metric)
+        if callback is not None:
+            callback(metric)
+
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    _callbacks.append(collect)
+    try:
+        yield metrics
+    finally:
+        _callbacks.remove(collect)
+        if started:
+            tracemalloc.stop()
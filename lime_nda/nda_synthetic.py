@@ -0,0 +1,138 @@
+# Synthetic nda files, for benchmarks and for trying the readers without real data
+
+import numpy as np
+from . import nda_version_8_0
+
+# Offset of the 'BTS Client' block in the header; the header fields are
+# written at the fixed offsets before it that NdaHeader reads them from
+BTS_CLIENT = 1500
+
+# Status codes of the steps of one cycle: rest, CCCV charge, rest, CC discharge
+DEFAULT_STEPS = (4, 7, 4, 2)
+
+# Sign of the current of each status code: charging, discharging or resting
+_CHARGE = {1: 1, 3: 1, 7: 1, 2: -1, 10: -1, 19: -1, 20: -1}
+
+
+def header_bytes(barcode='SYN000000001', process_name='synthetic', start_time='2024-01-01 00:00:00',
+                 remarks='', header_size=2048):
+    '''
+    Header of a synthetic nda file: the NEWARE magic, the start time,
+    remarks, barcode and process name at their offsets before the 'BTS
+    Client' block, and zero padding up to header_size bytes.
+    '''
+    if header_size < BTS_CLIENT + 14:
+        raise ValueError(f"header_size must be at least {BTS_CLIENT + 14} bytes")
+    fields = [(566, start_time, 19), (376, remarks, 115), (260, barcode, 99), (160, process_name, 59)]
+    header = bytearray(header_size)
+    header[:6] = b'NEWARE'
+    for before, text, length in fields:
+        data = text.encode()
+        if len(data) > length:
+            raise ValueError(f"{text!r} is longer than the {length} bytes of its header field")
+        header[BTS_CLIENT - before:BTS_CLIENT - before + len(data)] = data
+    header[BTS_CLIENT:BTS_CLIENT + 10] = b'BTS Client'
+    return bytes(header)
+
+
+def _main_records(first, count, records, cycles, steps, ranges, start, rng):
+    """Main records [first, first + count) of a file of records records"""
+    i = np.arange(first, first + count, dtype=np.int64)
+    runs = cycles * len(steps)
+    # Record i belongs to run i * runs // records, numbered across all cycles
+    run = i * runs // records
+    run_first = -(-run * records // runs)
+    status = np.asarray(steps, dtype=np.uint8)[run % len(steps)]
+    sign = np.array([_CHARGE.get(s, 0) for s in steps], dtype=np.int64)[run % len(steps)]
+    step_range = np.asarray(ranges, dtype=np.int32)[run % len(ranges)]
+    k = i - run_first
+
+    recs = np.zeros(count, dtype=nda_version_8_0._RECORD_DTYPE)
+    recs['marker'] = 0x55
+    recs['index'] = i + 1
+    recs['cycle'] = run // len(steps)
+    recs['step'] = run + 1
+    recs['status'] = status
+    recs['time'] = k * 1000
+    recs['voltage'] = 30000 + rng.integers(0, 12000, count)
+    current = sign * rng.integers(500, 20000, count)
+    recs['current'] = current
+    capacity = k * np.abs(current)
+    recs['charge_capacity'] = np.where(sign > 0, capacity, 0)
+    recs['discharge_capacity'] = np.where(sign < 0, capacity, 0)
+    recs['charge_energy'] = recs['charge_capacity'] * 4
+    recs['discharge_energy'] = recs['discharge_capacity'] * 4
+    recs['range'] = step_range
+
+    # One record per second from start
+    stamp = start + i.astype('m8[s]')
+    day = stamp.astype('M8[D]')
+    month = stamp.astype('M8[M]')
+    seconds = (stamp - day).astype(np.int64)
+    recs['year'] = stamp.astype('M8[Y]').astype(np.int64) + 1970
+    recs['month'] = month.astype(np.int64) % 12 + 1
+    recs['day'] = (day - month.astype('M8[D]')).astype(np.int64) + 1
+    recs['hour'] = seconds // 3600
+    recs['minute'] = seconds // 60 % 60
+    recs['second'] = seconds % 60
+    return recs
+
+
+def _aux_records(recs, aux_channels, rng):
+    """aux_channels temperature records for every main record, channel by channel"""
+    aux = np.zeros((len(recs), aux_channels), dtype=nda_version_8_0._RECORD_DTYPE)
+    aux['marker'] = 0x65
+    aux['aux'] = np.arange(1, aux_channels + 1)
+    aux['index'] = recs['index'][:, None]
+    aux['temperature'] = 250 + rng.integers(0, 100, aux.shape)
+    return aux
+
+
+def write_nda(path, records=10000, cycles=None, steps=DEFAULT_STEPS, aux_channels=0, ranges=(1000,),
+              duplicate_every=0, start_time='2024-01-01 00:00:00', barcode='SYN000000001',
+              process_name='synthetic', remarks='', header_size=2048, seed=0, chunk_size=1000000):
+    '''
+    Writes a synthetic nda file that the readers of this package decode like
+    a real one, and returns its path.
+
+    The file holds records main records, one per second from start_time,
+    split evenly over cycles cycles (by default one per 1000 records) of one
+    step per status code in steps. Each step uses the next current range
+    code of ranges in turn. Every main record is followed by aux_channels
+    temperature records, except the first one so the record region still
+    starts with two main records; with duplicate_every=n every n-th main
+    record (and its temperatures) is written twice. Voltages, currents and
+    temperatures are random, seeded by seed. The file is written chunk_size
+    records at a time, so files larger than memory can be generated.
+    '''
+    if cycles is None:
+        cycles = max(records // 1000, 1)
+    if records < 2 or not 1 <= cycles <= 65536 or cycles * len(steps) > records:
+        raise ValueError("records must be at least 2 and cover every step of 1 to 65536 cycles")
+    unknown = [r for r in ranges if r not in nda_version_8_0.multiplier_dict]
+    if unknown:
+        raise ValueError(f"Unknown current range codes {unknown}")
+    unknown = [s for s in steps if s not in nda_version_8_0.state_dict]
+    if unknown:
+        raise ValueError(f"Unknown status codes {unknown}")
+
+    rng = np.random.default_rng(seed)
+    start = np.datetime64(start_time, 's')
+    with open(path, 'wb') as f:
+        f.write(header_bytes(barcode, process_name, start_time, remarks, header_size))
+        for first in range(0, records, chunk_size):
+            count = min(chunk_size, records - first)
+            recs = _main_records(first, count, records, cycles, steps, ranges, start, rng)
+            # Raw 86 byte slots: concatenating the structured arrays would
+            # repack their overlapping fields
+            block = np.concatenate([recs.view('V86')[:, None],
+                                    _aux_records(recs, aux_channels, rng).view('V86')], axis=1)
+            keep = np.ones(block.shape, dtype=bool)
+            if first == 0:
+                keep[0, 1:] = False
+            if duplicate_every:
+                copies = np.where(recs['index'] % duplicate_every == 0, 2, 1)
+                block = np.repeat(block, copies, axis=0)
+                keep = np.repeat(keep, copies, axis=0)
+            f.write(block[keep].tobytes())
+    return path
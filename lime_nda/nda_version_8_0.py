@@ -2,14 +2,21 @@
 
 # from audioop import mul
 # import sys, getopt
-import struct
 # import binascii
 # import time
+import functools
 import logging
 import mmap
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 import re
-import datetime
+import numpy as np
 import pandas as pd
+from dateutil import tz
+from . import nda_cache
+from . import nda_profile
 ILLEGAL_CHARACTERS_RE = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
 
 def validate_timegap(df):
@@ -21,27 +28,132 @@ def validate_timegap(df):
     """
     
     
-    df['prev_step']=df['step_ID'].shift(periods=1)
-    
-    df['prev_tis']=df['time_in_step'].shift(periods=1)
-    df['prev_tstamp']=df['timestamp'].shift(periods=1)
-    df['prev_tis']=df['time_in_step']-df['prev_tis']
-    df['prev_tstamp']=df['timestamp']-df['prev_tstamp']
-    df['prev_tstamp']=df['prev_tstamp'].dt.total_seconds()
-    
-
-    #todo prev_tis and prev_tstamp now represent difference. of the time in step and timestamp 
-    df.loc[( (abs(df['prev_tis']-df['prev_tstamp'])>5) & ((df['step_ID']==df['prev_step']) & (df['time_in_step']!=0)) ),'Validated']=True
-    df.drop(columns=['prev_tis','prev_tstamp','prev_step'],inplace=True)
-       
-    
-
-
-
+    #todo records where time_in_step and timestamp advance differently set Validated to true
+    df.loc[_timegap(df), 'Validated'] = True
 
 
+def _timegap(df):
+    """
+    Records whose time_in_step and timestamp advanced more than 5 s apart
+    since the previous record of the same step (e.g. the power was cut).
+    """
+    step_ID = df['step_ID'].to_numpy()
+    time_in_step = df['time_in_step'].to_numpy(dtype=np.float64)
+    timestamp = df['timestamp'].to_numpy()
+    gap = np.zeros(len(df), dtype=bool)
+    if len(df) > 1:
+        drift = np.diff(time_in_step) - np.diff(timestamp) / np.timedelta64(1, 's')
+        gap[1:] = (abs(drift) > 5) & (step_ID[1:] == step_ID[:-1]) & (time_in_step[1:] != 0)
+    return gap
+
+
+# Bits of the per-record validation mask returned by validation_flags
+VALIDATION_FLAGS = {
+    'bad_index': 1 << 0,             # record_ID < 1
+    'bad_cycle': 1 << 1,             # cycle < 1
+    'bad_step': 1 << 2,              # step_ID < 1
+    'negative_time': 1 << 3,         # time_in_step < 0
+    'low_voltage': 1 << 4,           # voltage_V < 2
+    'negative_capacity': 1 << 5,
+    'negative_energy': 1 << 6,
+    'illegal_characters': 1 << 7,    # unknown or garbled step_name
+    'timegap': 1 << 8,               # see validate_timegap
+    'record_order': 1 << 9,          # record_ID (raw index in ID_flags) lower than the previous record's
+    'step_order': 1 << 10,           # step_ID (raw step in ID_flags) lower than the previous record's
+    'high_capacity': 1 << 11,        # capacity_mAh > 1500 * capacity_nom
+    'high_current': 1 << 12,         # current_mA > 1600 * capacity_nom
+}
+
+# The checks of single_validator; a record fails them unless it is in a timegap
+_RECORD_CHECKS = functools.reduce(lambda a, b: a | b, (VALIDATION_FLAGS[name] for name in (
+    'bad_index', 'bad_cycle', 'bad_step', 'negative_time', 'low_voltage',
+    'negative_capacity', 'negative_energy', 'illegal_characters')))
+
+# The checks of the raw record index and step. record_ID and step_ID are
+# renumbered while decoding, so they can no longer show them; frames decoded
+# with validate=False keep them in an ID_flags column.
+_ID_CHECKS = functools.reduce(lambda a, b: a | b, (VALIDATION_FLAGS[name] for name in (
+    'bad_index', 'bad_step', 'record_order', 'step_order')))
+
+
+def _value_flags(index, cycle, step, time_in_step, voltage, capacity, energy, name_ok):
+    """Per-record bitmask of the single_validator checks, applied to whole columns"""
+    flags = np.zeros(len(index), dtype=np.uint16)
+    for name, failed in (('bad_index', index < 1), ('bad_cycle', cycle < 1), ('bad_step', step < 1),
+                         ('negative_time', time_in_step < 0), ('low_voltage', voltage < 2),
+                         ('negative_capacity', capacity < 0), ('negative_energy', energy < 0),
+                         ('illegal_characters', ~name_ok)):
+        flags[failed] |= VALIDATION_FLAGS[name]
+    return flags
+
+
+def _id_flags(index, step, prev_index, prev_step, has_prev):
+    """
+    Bits of _ID_CHECKS for records with the raw index and step given,
+    against the kept record before each one (where has_prev is set)
+    """
+    flags = np.zeros(len(index), dtype=np.uint16)
+    flags[index < 1] |= VALIDATION_FLAGS['bad_index']
+    flags[step < 1] |= VALIDATION_FLAGS['bad_step']
+    flags[has_prev & (index < prev_index)] |= VALIDATION_FLAGS['record_order']
+    flags[has_prev & (step < prev_step)] |= VALIDATION_FLAGS['step_order']
+    return flags
 
 
+def validation_flags(df, capacity_nom=None):
+    """
+    Validates a records DataFrame in one vectorized pass.
+
+    Returns a uint16 array with one bitmask per record, built from the bits
+    of VALIDATION_FLAGS; 0 means the record passed every check. The capacity
+    and current limits are only checked when capacity_nom is given.
+
+    The index, step and order checks (_ID_CHECKS) are taken from the
+    ID_flags column of a frame decoded with validate=False, which holds them
+    for the raw record index and step. For such a frame the Validated column
+    nda_in_df_out would have decoded is
+    (flags & _RECORD_CHECKS == 0) | (flags & VALIDATION_FLAGS['timegap'] != 0).
+    On frames without ID_flags these checks run on record_ID and step_ID as
+    they are, which are already renumbered in the package's own output.
+    """
+    record_ID = df['record_ID'].to_numpy()
+    step_ID = df['step_ID'].to_numpy()
+    capacity = df['capacity_mAh'].to_numpy()
+    current = df['current_mA'].to_numpy()
+
+    # The name check runs once per distinct step name
+    codes, names = pd.factorize(df['step_name'])
+    name_ok = np.array([isinstance(name, str) and not ILLEGAL_CHARACTERS_RE.search(name)
+                        for name in names] + [False])[codes]
+
+    flags = _value_flags(record_ID, df['cycle'].to_numpy(), step_ID,
+                         df['time_in_step'].to_numpy(), df['voltage_V'].to_numpy(),
+                         capacity, df['energy_mWh'].to_numpy(), name_ok)
+    flags[_timegap(df)] |= VALIDATION_FLAGS['timegap']
+    flags[1:][record_ID[1:] < record_ID[:-1]] |= VALIDATION_FLAGS['record_order']
+    flags[1:][step_ID[1:] < step_ID[:-1]] |= VALIDATION_FLAGS['step_order']
+    if capacity_nom is not None:
+        flags[capacity > 1500 * capacity_nom] |= VALIDATION_FLAGS['high_capacity']
+        flags[current > 1600 * capacity_nom] |= VALIDATION_FLAGS['high_current']
+    if 'ID_flags' in df:
+        flags = (flags & ~np.uint16(_ID_CHECKS)) | df['ID_flags'].to_numpy(dtype=np.uint16)
+    return flags
+
+
+def validation_report(df, flags):
+    """
+    Summarises the flags of validation_flags: for every check the number of
+    failing records and the record_ID of the first one.
+    """
+    record_ID = df['record_ID'].to_numpy()
+    failed = []
+    first = []
+    for bit in VALIDATION_FLAGS.values():
+        hit = (flags & bit) != 0
+        failed.append(int(hit.sum()))
+        first.append(record_ID[hit.argmax()] if failed[-1] else pd.NA)
+    return pd.DataFrame({'failed': failed, 'first_record_ID': pd.array(first, dtype='Int64')},
+                        index=pd.Index(list(VALIDATION_FLAGS), name='check'))
 
 
 def main_validator(df,capacity_nom):
@@ -76,6 +188,10 @@ def main_validator(df,capacity_nom):
       True if the dataframe is valid, and False if it is not.
     """
   
+    if 'Validated' not in df:
+        # Decoded with validate=False
+        flags = validation_flags(df)
+        df['Validated'] = (flags & _RECORD_CHECKS) == 0
     validate_timegap(df)
     if(False in df.Validated.values):
         print('Df validation failed. Kindly check.')
@@ -127,61 +243,99 @@ def main_validator(df,capacity_nom):
    
     return True
 
+# Only this many bytes at the start of a file are searched for the header
+HEADER_WINDOW = 1 << 20
+
+
+def _until_nul(data, start, stop):
+    """Bytes from start up to the first NUL before stop"""
+    start = max(start, 0)
+    t = data.find(b'\x00', start, stop)
+    return data[start:t if t != -1 else stop]
+
+
+class NdaHeader:
+    """
+    Metadata stored in the header of an nda file.
+
+    Only the first HEADER_WINDOW bytes of the file are mapped and the
+    'BTS Client' block is located once; barcode, process name, start time and
+    remarks are all read at fixed offsets before it. Use read_header to get a
+    memoized instance instead of building one directly.
+    """
+
+    def __init__(self, inpath):
+        self.path = inpath
+        with open(inpath, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            data = b''
+            if size:
+                with mmap.mmap(f.fileno(), min(size, HEADER_WINDOW), access=mmap.ACCESS_READ) as mm:
+                    data = mm[:]
+        self.neware = data[:6] == b'NEWARE'
+        self.bts_client = data.find(b'BTS Client')
+        self.valid = self.bts_client != -1
+        x8 = self.bts_client
+        if self.valid:
+            self._process_name = _until_nul(data, x8-160, x8-100)
+            self._barcode = _until_nul(data, x8-260, x8)
+            self._remarks = _until_nul(data, x8-376, x8)
+            self._st_time = data[max(x8-566, 0):x8-547]
+
+    def _field(self, name):
+        if not self.valid:
+            raise ValueError(f"{self.path} does not appear to be a correctly downloaded Neware file.")
+        return getattr(self, name).decode()
+
+    @property
+    def process_name(self):
+        return self._field('_process_name')
+
+    @property
+    def barcode(self):
+        return self._field('_barcode')
+
+    @property
+    def remarks(self):
+        return self._field('_remarks')
+
+    @property
+    def st_time(self):
+        return self._field('_st_time')
+
+
+@functools.lru_cache(maxsize=16384)
+def _cached_header(path, mtime_ns, size):
+    return NdaHeader(path)
+
+
+def read_header(inpath):
+    """
+    Returns the NdaHeader of inpath, memoized per (path, mtime, size) so
+    repeated metadata lookups do not touch the file again.
+    """
+    st = os.stat(inpath)
+    return _cached_header(os.path.abspath(inpath), st.st_mtime_ns, st.st_size)
+
+
 def get_process_name(inpath):
-    with open(inpath, 'rb') as f:
-        data = f.read()
-        t = -1
-        x8=data.find(b'BTS Client')
-        for i in range(x8-160,x8-100):
-            if data[i:i+1] == b'\x00':
-                t = i
-                break
-        process_name=data[x8-160:t]
-    return process_name.decode()
+    return read_header(inpath).process_name
 
 
 def get_st_time(inpath):
-    with open(inpath, 'rb') as f:
-        data = f.read()
-        pos=data.find(b'BTS Client')
-
-        st_time2=data[pos-566:pos-547].decode()
+    return read_header(inpath).st_time
 
 
-        return(st_time2)
-    
 def get_barcode(inpath):
-    with open(inpath, 'rb') as f:
-        data = f.read()
-        t = -1
-        x8=data.find(b'BTS Client')
-        for i in range(x8-260,x8):
-            if data[i:i+1] == b'\x00':
-                t = i
-                break
-        barcode=data[x8-260:t]
-    return barcode.decode()
+    return read_header(inpath).barcode
+
 
 def get_remarks(inpath):
-    with open(inpath, 'rb') as f:
-        data = f.read()
-        t = -1
-        x8=data.find(b'BTS Client')
-        for i in range(x8-376,x8):
-            if data[i:i+1] == b'\x00':
-                t = i
-                break
-        remarks=data[x8-376:t]
-    return remarks.decode()
+    return read_header(inpath).remarks
+
 
 def ValidFile(inpath):
-    with open(inpath, 'rb') as f:
-        data = f.read()
-        pos=data.find(b'BTS Client')
-        if(pos==-1):
-            return False
-        else:
-            return True
+    return read_header(inpath).valid
 
         
 
@@ -213,223 +367,951 @@ def single_validator(List):
 
 
 
-# Return a dict containing the relevant data.  all nice and pretty like.
-def _bytes_to_list(byte_stream):
+state_dict = {
+    1: 'CC_Chg',
+    2: 'CC_Dchg',
+    3: 'CV_Chg',
+    4: 'Rest',
+    5: 'Cycle',
+    7: 'CCCV_Chg',
+    10: 'CR_Dchg',
+    13: 'Pause',
+    16: 'Pulse',
+    17: 'SIM',
+    19: 'CV_Dchg',
+    20: 'CCCV_Dchg'
+}
+range_list=[200000,-100000,-60000,-30000,-50000,-20000,-12000,-10000,-6000,-5000,-3000,-1000,-500,-100,0,10,100,200,1000,6000,12000,50000,60000]
+multiplier_dict = {
+    -200000: 1e-2,
+    -100000: 1e-2,
+    -60000: 1e-2,
+    -12000: 1e-2,
+    -30000: 1e-2,
+    -50000: 1e-2,
+    -20000: 1e-2,
+    -10000: 1e-2, 
+    
+    -6000: 1e-2,
+    -5000: 1e-2,
+    -3000: 1e-2,
+    -1000: 1e-2,
+    -500: 1e-3,
+    -100: 1e-3,
+    0: 0,
+    10: 1e-3,
+    100: 1e-2,
+    200: 1e-2,
+    1000: 1e-1,
+    6000: 1e-1,
+    12000: 1e-1,
+    50000: 1e-1,
+    60000: 1e-1,
+}
+
+rec_columns = [
+    'record_ID', 'cycle' ,'step_ID','step_name', 'time_in_step', 'voltage_V',
+    'current_mA', 'capacity_mAh','energy_mWh','timestamp','Validated']
+aux_columns = ['Index', 'Aux', 'T']
+dtype_dict = {
+    'record_ID': 'uint32',
+    'cycle': 'uint32',
+    'step_ID': 'uint32',
+    'step_name': 'str',
+    'time_in_step': 'uint32',
+    'voltage_V': 'float32',
+    'current_mA': 'float32',
+    'capacity_mAh': 'float32',
+    'energy_mWh': 'float32',
+    'DCIR': 'float32',
+    'Validated':'bool',
+    'ID_flags': 'uint16'
+}
+
+# Compact output: step_name as a Categorical over every known step name
+compact_dtype_dict = dict(dtype_dict, step_name=pd.CategoricalDtype(list(state_dict.values())))
+
+# Layout of one 86 byte record. Main (0x55) and auxiliary (0x65) records have
+# the same length, so a single structured dtype is laid over the whole record
+# region and each field is pulled out as a column. 'date_raw' overlaps the
+# packed date fields and is only used for the epoch fallback.
+_RECORD_DTYPE = np.dtype({
+    'names': ['marker', 'aux', 'index', 'cycle', 'step', 'status', 'time',
+              'voltage', 'current', 'temperature', 'charge_capacity',
+              'discharge_capacity', 'charge_energy', 'discharge_energy',
+              'year', 'month', 'day', 'hour', 'minute', 'second', 'date_raw',
+              'range', 'tail'],
+    'formats': ['u1', 'u1', '<u4', '<u2', '<u2', 'u1', '<u8', '<i4', '<i4',
+                '<i2', '<i8', '<i8', '<i8', '<i8', '<u2', 'u1', 'u1', 'u1',
+                'u1', 'u1', '<u8', '<i4', '<u4'],
+    'offsets': [0, 1, 2, 6, 10, 12, 14, 22, 26, 34, 38, 46, 54, 62, 70, 72,
+                73, 74, 75, 76, 70, 78, 82],
+    'itemsize': 86,
+})
+
+# Lookup tables so status codes and range codes are converted with one
+# indexing operation per column instead of a dict lookup per record.
+_STEP_NAMES = np.array([state_dict.get(i) for i in range(256)], dtype=object)
+_STEP_CODES = np.array([list(state_dict).index(i) if i in state_dict else -1 for i in range(256)],
+                       dtype=np.int8)
+_VALID_STEP_NAME = np.array([name is not None and not ILLEGAL_CHARACTERS_RE.search(name)
+                             for name in _STEP_NAMES])
+_RANGE_CODES = np.array(sorted(r for r in range_list if r in multiplier_dict))
+_RANGE_MULTIPLIERS = np.array([multiplier_dict[r] for r in _RANGE_CODES], dtype=np.float64)
+
+
+def _range_multiplier(ranges, index):
+    """Map raw range codes onto current multipliers"""
+    pos = np.searchsorted(_RANGE_CODES, ranges).clip(0, len(_RANGE_CODES) - 1)
+    known = _RANGE_CODES[pos] == ranges
+    if not known.all():
+        bad = np.argmin(known)
+        raise ValueError("At ",index[bad]," the ",ranges[bad]," range caused an error")
+    return _RANGE_MULTIPLIERS[pos]
+
+
+def _step_names(status, index, compact=False):
+    """Map raw status codes onto step names, as a Categorical when compact"""
+    codes = _STEP_CODES[status]
+    unknown = codes < 0
+    if unknown.any():
+        bad = np.argmax(unknown)
+        raise ValueError("At ",index[bad]," the ",status[bad]," status caused an error")
+    if compact:
+        return pd.Categorical.from_codes(codes, dtype=compact_dtype_dict['step_name'])
+    return _STEP_NAMES[status]
+
+
+def _decode_timestamps(recs, rows):
+    """
+    Build timestamps from the packed date fields, falling back to epoch seconds.
+
+    The calendar fields are combined with datetime64 arithmetic, so no
+    datetime object is created per record. Records whose fields are not a
+    valid date (within the datetime64[ns] range) instead hold seconds since
+    the epoch in the same 8 bytes, read as local time like
+    datetime.fromtimestamp.
+    """
+    year = recs['year'][rows].astype(np.int64)
+    month = recs['month'][rows].astype(np.int64)
+    day = recs['day'][rows].astype(np.int64)
+    hour = recs['hour'][rows].astype(np.int64)
+    minute = recs['minute'][rows].astype(np.int64)
+    second = recs['second'][rows].astype(np.int64)
+
+    months = (year - 1970) * 12 + month - 1
+    month_start = months.astype('datetime64[M]').astype('datetime64[D]')
+    next_month = (months + 1).astype('datetime64[M]').astype('datetime64[D]')
+    date = month_start + (day - 1)
+    valid = ((year >= 1678) & (year <= 2261) & (month >= 1) & (month <= 12) & (day >= 1)
+             & (date < next_month) & (hour < 24) & (minute < 60) & (second < 60))
 
-    List=[]
+    timestamps = date.astype('datetime64[s]') + (hour * 3600 + minute * 60 + second).astype('timedelta64[s]')
+    if not valid.all():
+        epoch = recs['date_raw'][rows[~valid]].astype(np.int64)
+        local = pd.to_datetime(epoch, unit='s', utc=True).tz_convert(tz.tzlocal()).tz_localize(None)
+        timestamps[~valid] = local.to_numpy().astype('datetime64[s]')
+    return timestamps.astype('datetime64[ns]')
 
-    state_dict = {
-        1: 'CC_Chg',
-        2: 'CC_Dchg',
-        3: 'CV_Chg',
-        4: 'Rest',
-        5: 'Cycle',
-        7: 'CCCV_Chg',
-        10: 'CR_Dchg',
-        13: 'Pause',
-        16: 'Pulse',
-        17: 'SIM',
-        19: 'CV_Dchg',
-        20: 'CCCV_Dchg'
+
+# Rows a compact decode converts at a time (see _decode_records)
+_COMPACT_BLOCK = 1 << 16
+
+
+def _decode_records(recs, rows, validate=True, compact=False, columns=None):
+    """
+    Vectorized decode of main records into the record columns.
+
+    recs is the zero-copy view over the record region and rows holds the
+    positions of the main records in it; each field is gathered straight from
+    the view, so no per-record bytes are ever allocated. With validate=False
+    the Validated column is left out. With compact the IDs are decoded as
+    uint32 and the measurements straight into float32 arrays, _COMPACT_BLOCK
+    rows at a time so their float64 intermediates stay small (the values are
+    those of the float64 decode narrowed), as are the timestamps; step_name
+    is then a Categorical and only time_in_step is float64, for the timegap
+    check. columns limits
+    the decode to the named record columns (Validated still reads the fields
+    it checks).
+    """
+    wanted = [col for col in rec_columns if (columns is None or col in columns)
+              and (validate or col != 'Validated')]
+    needed = set(wanted)
+    if 'Validated' in needed:
+        needed.update(('cycle', 'step_ID', 'time_in_step', 'voltage_V', 'capacity_mAh', 'energy_mWh'))
+
+    ids = np.uint32 if compact else np.int64
+    index = recs['index'][rows].astype(ids)
+    status = recs['status'][rows]
+    decoded = {'record_ID': index}
+    if 'cycle' in needed:
+        decoded['cycle'] = np.add(recs['cycle'][rows], 1, dtype=ids)
+    if 'step_ID' in needed:
+        decoded['step_ID'] = recs['step'][rows].astype(ids)
+    if 'step_name' in needed:
+        decoded['step_name'] = _step_names(status, index, compact)
+    if 'time_in_step' in needed:
+        decoded['time_in_step'] = recs['time'][rows] / 1000
+    measurements = {
+        'voltage_V': lambda r: recs['voltage'][r] / 10000,
+        'current_mA': lambda r: recs['current'][r] * _range_multiplier(recs['range'][r], recs['index'][r]),
+        'capacity_mAh': lambda r: (np.abs(recs['charge_capacity'][r] - recs['discharge_capacity'][r])
+                                   * _range_multiplier(recs['range'][r], recs['index'][r]) / 3600),
+        'energy_mWh': lambda r: (np.abs(recs['charge_energy'][r] - recs['discharge_energy'][r])
+                                 * _range_multiplier(recs['range'][r], recs['index'][r]) / 3600),
     }
-    range_list=[200000,-100000,-60000,-30000,-50000,-20000,-12000,-10000,-6000,-5000,-3000,-1000,-500,-100,0,10,100,200,1000,6000,12000,50000,60000]
-    multiplier_dict = {
-        -200000: 1e-2,
-        -100000: 1e-2,
-        -60000: 1e-2,
-        -12000: 1e-2,
-        -30000: 1e-2,
-        -50000: 1e-2,
-        -20000: 1e-2,
-        -10000: 1e-2, 
-        
-        -6000: 1e-2,
-        -5000: 1e-2,
-        -3000: 1e-2,
-        -1000: 1e-2,
-        -500: 1e-3,
-        -100: 1e-3,
-        0: 0,
-        10: 1e-3,
-        100: 1e-2,
-        200: 1e-2,
-        1000: 1e-1,
-        6000: 1e-1,
-        12000: 1e-1,
-        50000: 1e-1,
-        60000: 1e-1,
+    measurements['timestamp'] = lambda r: _decode_timestamps(recs, r)
+    for name, measure in measurements.items():
+        if name not in needed:
+            continue
+        if not compact:
+            decoded[name] = measure(rows)
+            continue
+        decoded[name] = np.empty(len(rows), dtype='datetime64[ns]' if name == 'timestamp' else np.float32)
+        for start in range(0, len(rows), _COMPACT_BLOCK):
+            decoded[name][start:start + _COMPACT_BLOCK] = measure(rows[start:start + _COMPACT_BLOCK])
+    if 'Validated' in needed:
+        decoded['Validated'] = _value_flags(index, decoded['cycle'], decoded['step_ID'], decoded['time_in_step'],
+                                            decoded['voltage_V'], decoded['capacity_mAh'], decoded['energy_mWh'],
+                                            _VALID_STEP_NAME[status]) == 0
+    return {col: decoded[col] for col in wanted}
+
+
+def _decode_aux(recs, rows):
+    """Vectorized decode of auxiliary (temperature) records"""
+    return {
+        'Index': recs['index'][rows].astype(np.int64),
+        'Aux': recs['aux'][rows].astype(np.int64),
+        'T': recs['temperature'][rows] / 10,
     }
 
 
-    [Index, Cycle] = struct.unpack('<IH', byte_stream[2:8])
-    # [Step] = struct.unpack('<I', byte_stream[10:14])
-    [Status, Jump, Time] = struct.unpack('<BBQ', byte_stream[12:22])    #state_dict[Status] is step_name
-    [Step] = struct.unpack('<H', byte_stream[10:12])
-    [Voltage, Current] = struct.unpack('<ii', byte_stream[22:30])
-    [Charge_capacity, Discharge_capacity] = struct.unpack('<qq', byte_stream[38:54])
-    [Charge_energy, Discharge_energy] = struct.unpack('<qq', byte_stream[54:70])
-    [Y, M, D, h, m, s] = struct.unpack('<HBBBBB', byte_stream[70:77])
-    [Range] = struct.unpack('<i', byte_stream[78:82])
+def aux_block(aux_df):
+    """
+    Pivots auxiliary records (Index, Aux, T columns) into one wide float32
+    block: a row per record index, a T{Aux} column per channel in channel
+    order. Where a channel logged a record index more than once the first
+    reading is kept; channels without a reading for an index hold NaN.
+    """
+    index = aux_df['Index'].to_numpy()
+    if (index[1:] >= index[:-1]).all():
+        # Already in record order, as written by BTS
+        changed = np.ones(len(index), dtype=bool)
+        changed[1:] = index[1:] != index[:-1]
+        rows = np.cumsum(changed) - 1
+        index = index[changed]
+    else:
+        index, rows = np.unique(index, return_inverse=True)
+    channels, cols = np.unique(aux_df['Aux'].to_numpy(), return_inverse=True)
+    block = np.full((len(index), len(channels)), np.nan, dtype=np.float32)
+    # Later writes win, so write in reverse to keep the first reading
+    block[rows[::-1], cols[::-1]] = aux_df['T'].to_numpy()[::-1]
+    return pd.DataFrame(block, index=pd.Index(index, name='Index'),
+                        columns=[f"T{channel}" for channel in channels])
 
-    try:
-        Date = datetime.datetime(Y, M, D, h, m, s)
 
-    except ValueError:
-        [Timestamp] = struct.unpack('<Q', byte_stream[70:78])
-        Date = datetime.datetime.fromtimestamp(Timestamp)
+def read_aux(file):
+    """
+    Decodes only the auxiliary records of file, as the wide block of
+    aux_block, without decoding or joining the main records.
+    """
+    return _aux_records_block(_map_records(file))
 
-    if(Range in range_list):
-        multiplier = multiplier_dict[Range]
-    else:
-        raise ValueError("At ",Index," the ",Range," range caused an error")
-    
-    List = [
-        Index,
-        Cycle + 1,
-        Step,
-        state_dict[Status],
-        Time/1000,
-        Voltage/10000,
-        Current*multiplier,
-        abs(Charge_capacity-Discharge_capacity) *multiplier/3600,
-        abs(Charge_energy-Discharge_energy)*multiplier/3600,
-        Date,
-    ]
 
-   
-    List.append(single_validator(List))
-    return List
-    
-        
-    
-def _aux_bytes_to_list(bytes):
-    """Helper function for intepreting auxiliary records"""
-    [Aux] = struct.unpack('<B', bytes[1:2])
-    [Index, Cycle] = struct.unpack('<IB', bytes[2:7])
-    [T] = struct.unpack('<h', bytes[34:36])
+def _aux_records_block(recs):
+    """aux_block of the auxiliary records of the record view recs"""
+    _, rows = _record_rows(recs)
+    # No drop_duplicates needed: aux_block keeps the first reading anyway
+    return aux_block(pd.DataFrame(_decode_aux(recs, rows), columns=aux_columns))
 
-    list = [
-        Index,
-        Aux,
-        T/10
-    ]
 
-    return(list)
+def _join_aux(df, block):
+    """
+    Append the columns of aux_block to df, aligned on the raw record index;
+    NaN where block has no reading (e.g. it is empty)
+    """
+    pos = block.index.get_indexer(df['record_ID'].to_numpy())
+    found = pos >= 0
+    values = np.full((len(df), len(block.columns)), np.nan, dtype=np.float32)
+    values[found] = block.to_numpy()[pos[found]]
+    return pd.concat([df, pd.DataFrame(values, index=df.index, columns=block.columns)], axis=1)
 
 
+def _valid_record(buf, offset):
+    """Helper function to identify a valid record starting at offset"""
+    # Check for a non-zero Status
+    return(buf[offset + 12] != 0)
 
 
+# Bytes before and at the start of a record: the zero tail of the previous
+# 86 byte slot, then the 0x55 marker and 0 aux byte of a main record
+_RECORD_START = np.frombuffer(b'\x00\x00\x00\x00\x55\x00', dtype=np.uint8)
 
+# The record start is searched in windows growing from 4 KiB up to this size
+SEARCH_WINDOW = 1 << 20
 
-def _valid_record(bytes):
-    """Helper function to identify a valid record"""
-    # Check for a non-zero Status
-    [Status] = struct.unpack('<B', bytes[12:13])
-    return(Status != 0)
 
+def _first_record(buf, start):
+    """
+    Offset of the first record at or after start in buf (a uint8 array), or
+    -1. A record starts after a zero tail with a main record marker, and it
+    must have a non-zero status and be followed 86 bytes on by another main
+    record (unless it is the last slot of the file). All candidates of a
+    window are found and confirmed at once; the window doubles after every
+    miss, up to SEARCH_WINDOW bytes.
+    """
+    record_len = 86
+    size = len(buf)
+    window = 1 << 12
+    while start + len(_RECORD_START) <= size:
+        stop = min(start + window, size - len(_RECORD_START) + 1)
+        window = min(window * 2, SEARCH_WINDOW)
+        n = stop - start
+        hit = np.ones(n, dtype=bool)
+        for k, byte in enumerate(_RECORD_START):
+            hit &= buf[start + k:stop + k] == byte
+        candidates = np.flatnonzero(hit) + start + 4
+        following = candidates + record_len
+        inside = following < size
+        confirmed = ~inside
+        confirmed[inside] = (buf[following[inside]] == 0x55) & _valid_record(buf, candidates[inside])
+        if confirmed.any():
+            return int(candidates[np.argmax(confirmed)])
+        start = stop
+    return -1
+
+
+def _find_records(file):
+    """Byte offset of the first record in file, after checking it is a Neware file"""
+    header = read_header(file)
+    if not header.neware:
+        raise ValueError(f"{file} does not appear to be a Neware file.")
+    if not header.valid:
+        raise ValueError(f"{file} does not appear to be a correctly downloaded Neware file.")
+
+    with open(file, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with mm:
+        buf = np.frombuffer(mm, dtype=np.uint8)
+        # The records follow the header, which ends after the 'BTS Client' block
+        offset = _first_record(buf, header.bts_client)
+        del buf
+    if offset == -1:
+        raise EOFError(f"File {file} does not contain any valid records.")
+    return offset
+
+
+@functools.lru_cache(maxsize=16384)
+def _cached_offset(path, mtime_ns, size):
+    return _find_records(path)
+
+
+def record_offset(file):
+    """
+    Byte offset of the first record of an nda file (the length of its
+    header), memoized per (path, mtime, size) like read_header so every
+    reader of an unchanged file searches for it once.
+    """
+    st = os.stat(file)
+    return _cached_offset(os.path.abspath(file), st.st_mtime_ns, st.st_size)
 
-#! Output for newest BTSDA version
-def nda_in_df_out(file):
-  
-    
-    rec_columns = [
-    'record_ID', 'cycle' ,'step_ID','step_name', 'time_in_step', 'voltage_V',
-    'current_mA', 'capacity_mAh','energy_mWh','timestamp','Validated']
-    aux_columns = ['Index', 'Aux', 'T']
 
+def _map_records(file, offset=None, skip=0):
+    """
+    Map the record region of an nda file without copying it.
+
+    Returns a structured array view over the mmap covering every full 86 byte
+    slot from offset (found with record_offset when not given), leaving out
+    the first skip records and any partially written record at the end. The
+    mmap stays open for as long as the view (or a view derived from it) is
+    referenced.
+    """
     record_len = 86
-    main_data = False
+    if offset is None:
+        offset = record_offset(file)
     with open(file, "rb") as f:
         mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-        mm_size = mm.size()
+    count = max((mm.size() - offset) // record_len - skip, 0)
+    return np.frombuffer(mm, dtype=_RECORD_DTYPE, count=count, offset=offset + skip * record_len)
 
-        if mm.read(6) != b'NEWARE':
-            raise ValueError(f"{file} does not appear to be a Neware file.")
 
-        if(mm.find(b'BTS Client')==-1):
-            raise ValueError(f"{file} does not appear to be a correctly downloaded Neware file.")
-    
-        identifier = b'\x00\x00\x00\x00\x55\x00'
-        header = mm.find(identifier)
-        if header == -1:
-            raise EOFError(f"File {file} does not contain any valid records.")
-        while (((mm[header + 4 + record_len] != 85) | (not _valid_record(mm[header+4:header+4+record_len]))) if header + 4 + record_len < mm_size
-               else False):
-            header = mm.find(identifier, header + 4)
-        mm.seek(header + 4)
-
-        output = []
-        aux = []
-        while mm.tell() < mm_size:
-            bytes = mm.read(record_len)
-            if len(bytes) == record_len:
-
-                # Check for a data record
-                
-                if (bytes[0:2] == b'\x55\x00'
-                        and bytes[82:87] == b'\x00\x00\x00\x00'):
-                                       
-                    output.append( _bytes_to_list(bytes))
-
-                # Check for an auxiliary record
-                elif (bytes[0:1] == b'\x65'
-                      and bytes[82:87] == b'\x00\x00\x00\x00'):
-                    aux.append(_aux_bytes_to_list(bytes))
-
-    df = pd.DataFrame(output, columns=rec_columns)
-    
-    df.dropna(inplace=True)
-    df.drop_duplicates(inplace=True)
-    
-    if(get_barcode(file).startswith('0AD')):
-        df.drop(df.index[df['step_ID']<7],axis=0,inplace=True)
-    df.record_ID = _count_changes(df.record_ID)
-    df.step_ID = _count_changes(df.step_ID)
+def _record_rows(recs):
+    """Positions of the main and auxiliary records in the record view"""
+    tail_ok = recs['tail'] == 0
+    main = np.flatnonzero((recs['marker'] == 0x55) & (recs['aux'] == 0) & tail_ok)
+    aux = np.flatnonzero((recs['marker'] == 0x65) & tail_ok)
+    return main, aux
 
-    if not df.record_ID.is_monotonic_increasing:
-        df.sort_values('record_ID', inplace=True)
 
-    df.reset_index(drop=True, inplace=True)
-    
-    #todo sets timegap records Validation to true
-    validate_timegap(df)
-    
-    # Join temperature data
-    aux_df = pd.DataFrame(aux, columns=aux_columns)
+# Files with fewer records than this are not worth splitting across processes
+MIN_SHARD_RECORDS = 200000
 
 
-   
+def _scan_shard(file, offset, start, stop, aux=True):
+    """
+    Finds the records among record slots [start, stop) of file inside a
+    worker process. Returns the positions of the main records in the whole
+    record region and, with aux, the decoded auxiliary records.
+    """
+    recs = _map_records(file, offset, start)[:stop - start]
+    main, aux_rows = _record_rows(recs)
+    return main + start, _decode_aux(recs, aux_rows) if aux else None
 
-    aux_df.drop_duplicates(inplace=True)
-    if not aux_df.empty:
-        for Aux in aux_df.Aux.unique():
-            df = df.join(aux_df.loc[aux_df.Aux == Aux, 'T']) # type: ignore
-            df.rename(columns={'T': f"T{Aux}"}, inplace=True)
-   
-    
-    #!DCIR Calculation
-    df['prev_cur']=df['current_mA'].shift(periods=1)
-    df['prev_vol']=df['voltage_V'].shift(periods=1)
-    df['DCIR']=-1
-    df.loc[((df['prev_cur']==0)&(df['current_mA']!=0)),'DCIR']=abs((df['voltage_V']-df['prev_vol'])/(df['current_mA']-df['prev_cur']))*1000
-    df.drop(columns=['prev_cur','prev_vol'],inplace=True)
-
-    dtype_dict = {
-        'record_ID': 'uint32',
-        'cycle': 'uint32',
-        'step_ID': 'uint32',
-        'step_name': 'str',
-        'time_in_step': 'uint32',
-        'voltage_V': 'float32',
-        'current_mA': 'float32',
-        'capacity_mAh': 'float32',
-        'energy_mWh': 'float32',
-        'DCIR': 'float32',
-        'Validated':'bool'
-    }
-    df = df.astype(dtype=dtype_dict)
-    return df
-   
+
+def _assemble_shard(file, offset, out, *args):
+    """
+    _assemble(recs, *args) over the record region of file inside a worker
+    process. The frame is written column-wise to out, so the parent reads it
+    back without unpickling a DataFrame.
+    """
+    nda_cache.write_table(out, _assemble(_map_records(file, offset), *args))
+    return out
+
+
+#! Output for newest BTSDA version
+def nda_in_df_out(file, workers=1, validate=True, aux=True, compact=False):
+    """
+    Decodes an nda file into a record-wise DataFrame.
+
+    With workers > 1 the record region is decoded in parallel shards
+    (see _stitch_shards); the result is the same. With validate=False the
+    per-record checks are skipped and the Validated column is left out;
+    only the checks of the raw record index and step, which renumbering
+    hides, are kept as the ID_flags column, so validation_flags can be run
+    on the result later. The temperature
+    channels are joined as T{Aux} columns on the record index unless aux is
+    False.
+
+    With compact the columns take their final dtypes while decoding and
+    step_name is a Categorical (see compact_dtype_dict): 46 bytes per record
+    instead of about 110, not counting temperature columns. DCIR is then
+    computed from the float32 voltages and currents.
+
+    Duplicates are found from a digest of the raw fields of each record
+    and record_ID/step_ID are renumbered on the raw arrays (see
+    _kept_records), so only the records that are kept are decoded.
+
+    Each stage is reported to nda_profile.profile blocks when one is active.
+    """
+    if workers > 1:
+        return _stitch_shards(file, workers, validate, aux, compact)
+
+    with nda_profile.stage('nda_in_df_out', 'find_records') as stage:
+        offset = record_offset(file)
+        stage.bytes = offset
+    recs = _map_records(file, offset)
+
+    with nda_profile.stage('nda_in_df_out', 'dedup_renumber', len(recs), recs.nbytes):
+        main, record_ID, step_ID, _ = _kept_records(file, recs)
+
+    block = None
+    if aux:
+        with nda_profile.stage('nda_in_df_out', 'aux') as stage:
+            block = _aux_records_block(recs)
+            stage.records = len(block)
+    channels = [] if block is None else [int(col[1:]) for col in block.columns]
+
+    # Each kept record's predecessor feeds the timegap check and DCIR
+    with nda_profile.stage('nda_in_df_out', 'assemble', len(main)):
+        prev = (np.arange(len(main)) - 1).clip(0)
+        prev_rows = np.where(np.arange(len(main)) > 0, main[prev], -1)
+        return _assemble(recs, main, prev_rows, record_ID, step_ID, step_ID[prev], pd.RangeIndex(len(main)),
+                         _output_columns(None, validate, channels), validate, compact, block)
+
+
+def _stitch_shards(file, workers, validate=True, aux=True, compact=False):
+    """
+    nda_in_df_out with the work split across workers processes.
+
+    Records are fixed length, so the record region is cut at multiples of
+    86 bytes and each shard is scanned for its main records (and decodes its
+    aux records) in its own process. Deduplication and the record_ID/step_ID
+    numbering need the whole file, but only the raw index and step fields of
+    the main records, so the parent works them out with _kept_records and
+    builds the aux block. The kept records are then split into contiguous
+    runs that the workers decode with _assemble, and the frames are
+    concatenated in file order. The first record of each run gets the last
+    record of the run before it as its predecessor, so the timegap check and
+    DCIR are the same as in one pass.
+    """
+    with nda_profile.stage('nda_in_df_out', 'find_records') as stage:
+        offset = record_offset(file)
+        stage.bytes = offset
+    recs = _map_records(file, offset)
+    if len(recs) < MIN_SHARD_RECORDS:
+        return nda_in_df_out(file, 1, validate, aux, compact)
+
+    handoff = tempfile.mkdtemp(prefix='lime_nda_')
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            with nda_profile.stage('nda_in_df_out', 'scan_shards', len(recs), recs.nbytes):
+                bounds = np.linspace(0, len(recs), workers + 1).astype(int)
+                # result() re-raises an error of the earliest failing shard
+                scans = [future.result() for future in
+                         [pool.submit(_scan_shard, file, offset, bounds[i], bounds[i + 1], aux)
+                          for i in range(workers)]]
+
+            with nda_profile.stage('nda_in_df_out', 'dedup_renumber', len(recs)):
+                main, record_ID, step_ID, _ = _kept_records(
+                    file, recs, np.concatenate([rows for rows, _ in scans]))
+
+            block = None
+            if aux:
+                with nda_profile.stage('nda_in_df_out', 'aux') as stage:
+                    block = aux_block(pd.DataFrame({col: np.concatenate([data[col] for _, data in scans])
+                                                    for col in aux_columns}))
+                    stage.records = len(block)
+            del scans
+            channels = [] if block is None else [int(col[1:]) for col in block.columns]
+            columns = _output_columns(None, validate, channels)
+
+            with nda_profile.stage('nda_in_df_out', 'assemble_shards', len(main)):
+                prev = (np.arange(len(main)) - 1).clip(0)
+                prev_rows = np.where(np.arange(len(main)) > 0, main[prev], -1)
+                prev_step_ID = step_ID[prev]
+                runs = np.linspace(0, len(main), workers + 1).astype(int)
+                futures = []
+                for i, (lo, hi) in enumerate(zip(runs[:-1], runs[1:])):
+                    part = block
+                    if block is not None:
+                        # Only the aux rows within the run's range of record indexes
+                        index = recs['index'][main[lo:hi]]
+                        part = block.iloc[:0] if hi == lo else block.iloc[
+                            block.index.searchsorted(index.min()):block.index.searchsorted(index.max(), 'right')]
+                    futures.append(pool.submit(
+                        _assemble_shard, file, offset, os.path.join(handoff, str(i)), main[lo:hi],
+                        prev_rows[lo:hi], record_ID[lo:hi], step_ID[lo:hi], prev_step_ID[lo:hi],
+                        pd.RangeIndex(lo, hi), columns, validate, compact, part))
+                frames = [nda_cache.read_table(future.result(), mmap=False) for future in futures]
+                return pd.concat(frames, ignore_index=True)
+    finally:
+        shutil.rmtree(handoff, ignore_errors=True)
+
+
+def _record_digest(recs, rows):
+    """
+    64 bit digest of the values the main records at rows decode to, so
+    duplicated records can be dropped without decoding them first.
+    """
+    index = recs['index'][rows]
+    multiplier = _range_multiplier(recs['range'][rows], index)
+    return pd.util.hash_pandas_object(pd.DataFrame({
+        'index': index,
+        'cycle': recs['cycle'][rows],
+        'step': recs['step'][rows],
+        'status': recs['status'][rows],
+        'time': recs['time'][rows],
+        'voltage': recs['voltage'][rows],
+        'current': recs['current'][rows] * multiplier,
+        'capacity': np.abs(recs['charge_capacity'][rows] - recs['discharge_capacity'][rows]) * multiplier,
+        'energy': np.abs(recs['charge_energy'][rows] - recs['discharge_energy'][rows]) * multiplier,
+        # Bytes 70-76: the date fields, or the epoch seconds fallback
+        'date': recs['date_raw'][rows] & np.uint64(0x00FFFFFFFFFFFFFF),
+    }), index=False).to_numpy()
+
+
+_AUX_COLUMN_RE = re.compile(r'T\d+$')
+
+
+def _kept_records(file, recs, main=None):
+    """
+    Main records of the record view recs that nda_in_df_out keeps, found
+    from the raw fields without decoding. main holds the positions of all
+    main records when they are already known (see _record_rows).
+
+    Returns the positions of the kept records, their renumbered record_ID
+    and step_ID, and the positions of the main records dropped as
+    duplicates.
+    """
+    if main is None:
+        main, _ = _record_rows(recs)
+    # A duplicate repeats the raw index of the record it copies, so only
+    # records whose index occurs more than once are digested
+    index = recs['index'][main]
+    duplicated = np.zeros(len(main), dtype=bool)
+    if not (index[1:] > index[:-1]).all():
+        _, inverse, counts = np.unique(index, return_inverse=True, return_counts=True)
+        repeated = np.flatnonzero(counts[inverse] > 1)
+        duplicated[repeated] = pd.Series(_record_digest(recs, main[repeated])).duplicated().to_numpy()
+    dropped = main[duplicated]
+    main = main[~duplicated]
+    if get_barcode(file).startswith('0AD'):
+        main = main[recs['step'][main] >= 7]
+    if len(main):
+        record_ID = _renumber(recs['index'][main], None, True)[0]
+        step_ID = _renumber(recs['step'][main], None, True)[0]
+    else:
+        record_ID = step_ID = np.empty(0, dtype=np.uint32)
+    return main, record_ID, step_ID, dropped
 
 
+def _output_columns(columns, validate, channels):
+    """
+    Columns of a records frame: the requested ones, or all of them in
+    nda_in_df_out order. Without validate ID_flags takes the place of
+    Validated.
+    """
+    if columns is None:
+        return ([col if validate or col != 'Validated' else 'ID_flags' for col in rec_columns]
+                + [f"T{channel}" for channel in channels] + ['DCIR'])
+    columns = [col for col in columns if validate or col != 'Validated']
+    unknown = [col for col in columns if col not in rec_columns + ['DCIR', 'ID_flags']
+               and not _AUX_COLUMN_RE.match(col)]
+    if unknown:
+        raise ValueError(f"Unknown columns {unknown}")
+    return columns
+
+
+def dcir(voltage, current, prev_voltage, prev_current):
+    """
+    DC internal resistance of each record, in mΩ, as float32: abs(dV/dI) *
+    1000 against the record before it where that record was at rest and this
+    one is under load, -1 elsewhere. prev_voltage and prev_current hold the
+    values of the record before each one (NaN where there is none). Taken at
+    the first record of each step it is the step DCIR of step(); cycle()
+    averages its positive values per cycle.
+    """
+    # Computed in the precision of the decoded columns (float32 when compact)
+    prev_voltage = np.asarray(prev_voltage, dtype=voltage.dtype)
+    prev_current = np.asarray(prev_current, dtype=current.dtype)
+    DCIR = np.full(len(current), -1.0)
+    load = (prev_current == 0) & (current != 0)
+    DCIR[load] = abs((voltage[load] - prev_voltage[load]) / (current[load] - prev_current[load])) * 1000
+    return DCIR.astype(np.float32)
+
+
+def _assemble(recs, rows, prev_rows, record_ID, step_ID, prev_step_ID, labels, columns, validate, compact, block):
+    """
+    Builds the records frame for the main records at rows of recs.
+
+    prev_rows holds the position of the kept record before each one (-1 for
+    none), which feeds the timegap check and DCIR; record_ID, step_ID and
+    prev_step_ID are the renumbered IDs of the records and of those before
+    them; ID_flags (see _id_flags) compares their raw fields instead. Only
+    the fields behind columns are decoded. Temperature columns
+    are taken from block (see aux_block), NaN where it has no reading.
+    """
+    needed = [col for col in rec_columns if col in columns and col not in ('record_ID', 'step_ID')]
+    with_prev = 'Validated' in columns or 'DCIR' in columns
+    if 'Validated' in columns:
+        needed += ['time_in_step', 'timestamp']
+    if 'DCIR' in columns:
+        needed += ['voltage_V', 'current_mA']
+    has_prev = prev_rows >= 0
+    if with_prev and len(rows) and np.array_equal(prev_rows[1:], rows[:-1]):
+        # Consecutive kept records (e.g. all of them, or a run of them):
+        # each one's predecessor is the row before it, and the decoded
+        # columns are taken as views rather than gathered again
+        if prev_rows[0] < 0:
+            decode = rows
+            pos = slice(None)
+            prev_pos = (np.arange(len(rows)) - 1).clip(0)
+        else:
+            decode = np.append(prev_rows[0], rows)
+            pos = slice(1, None)
+            prev_pos = np.arange(len(rows))
+    else:
+        decode = np.union1d(rows, prev_rows[has_prev]) if with_prev else rows
+        pos = np.searchsorted(decode, rows)
+        prev_pos = np.searchsorted(decode, prev_rows.clip(0)).clip(0, max(len(decode) - 1, 0))
+    data = _decode_records(recs, decode, validate, compact, needed)
+
+    out = {'record_ID': record_ID, 'step_ID': step_ID}
+    for col in data:
+        out[col] = data[col][pos]
+    if 'Validated' in out:
+        # Same rule as validate_timegap
+        time_in_step = data['time_in_step']
+        timestamp = data['timestamp']
+        gap = (time_in_step[pos] - time_in_step[prev_pos]) - (timestamp[pos] - timestamp[prev_pos]) / np.timedelta64(1, 's')
+        out['Validated'][has_prev & (abs(gap) > 5) & (step_ID == prev_step_ID)
+                         & (time_in_step[pos] != 0)] = True
+    if 'DCIR' in columns:
+        current = data['current_mA']
+        voltage = data['voltage_V']
+        out['DCIR'] = dcir(voltage[pos], current[pos], voltage[prev_pos],
+                           np.where(has_prev, current[prev_pos], np.nan))
+    if 'ID_flags' in columns:
+        prev = prev_rows.clip(0)
+        out['ID_flags'] = _id_flags(recs['index'][rows], recs['step'][rows],
+                                    recs['index'][prev], recs['step'][prev], has_prev)
+    temperature_columns = [col for col in columns if _AUX_COLUMN_RE.match(col)]
+    for col in temperature_columns:
+        out[col] = np.full(len(rows), np.nan, np.float32)
+    if temperature_columns and block is not None:
+        temperatures = _join_aux(pd.DataFrame({'record_ID': recs['index'][rows]}), block)
+        for col in temperature_columns:
+            if col in temperatures:
+                out[col] = temperatures[col].to_numpy()
+
+    # Columns already in their final dtype (all of them when compact) are not copied
+    df = pd.DataFrame({col: out[col] for col in columns}, index=labels, copy=False)
+    dtypes = compact_dtype_dict if compact else dtype_dict
+    return df.astype(dtype={col: dtype for col, dtype in dtypes.items() if col in df}, copy=False)
+
+
+def select_records(file, columns=None, cycles=None, time_range=None, validate=True, aux=True, compact=False):
+    """
+    Decodes only the requested columns of the records matching the predicates.
+
+    cycles is a collection of cycle numbers and time_range a (start, end)
+    pair selecting start <= timestamp < end, either end may be None. columns
+    names record columns, 'DCIR' and temperature columns (T1, T2, ...). The
+    cycle field is compared straight off the mmap and timestamps are only
+    built for records in the selected cycles; everything else is decoded
+    for the selected records (and the record before each, for the timegap
+    check and DCIR) only. Duplicates and the record_ID/step_ID numbering
+    are still worked out over the whole file, from a digest of the raw
+    fields, so the result equals nda_in_df_out(file).loc[mask, columns],
+    index included.
+    """
+    recs = _map_records(file)
+    main, record_ID, step_ID, _ = _kept_records(file, recs)
+
+    block = None
+    if (columns is None and aux) or (columns is not None and any(_AUX_COLUMN_RE.match(col) for col in columns)):
+        block = read_aux(file)
+    columns = _output_columns(columns, validate, [] if block is None else [int(col[1:]) for col in block.columns])
+
+    keep = np.ones(len(main), dtype=bool)
+    if cycles is not None:
+        keep &= np.isin(recs['cycle'][main].astype(np.int64) + 1, np.asarray(list(cycles), dtype=np.int64))
+    sel = np.flatnonzero(keep)
+    if time_range is not None:
+        start, end = time_range
+        timestamp = _decode_timestamps(recs, main[sel])
+        inside = np.ones(len(sel), dtype=bool)
+        if start is not None:
+            inside &= timestamp >= pd.Timestamp(start).to_datetime64()
+        if end is not None:
+            inside &= timestamp < pd.Timestamp(end).to_datetime64()
+        sel = sel[inside]
+
+    prev = (sel - 1).clip(0)
+    prev_rows = np.where(sel > 0, main[prev], -1)
+    return _assemble(recs, main[sel], prev_rows, record_ID[sel], step_ID[sel], step_ID[prev],
+                     sel, columns, validate, compact, block)
+
+
+def _row_digest(df):
+    """64 bit digest of every row, used to spot duplicated records"""
+    return pd.util.hash_pandas_object(df, index=False).to_numpy()
+
+
+# The streaming readers drop a duplicated record when the record it copies
+# is among the digests of at least this many records before it
+DEDUP_LOOKBACK = 4096
+
+
+def _drop_seen(df, seen):
+    """
+    Drop rows of df that are duplicated within df or whose digest is in seen.
+
+    Returns the deduplicated frame and the digests to be passed as seen for
+    the next chunk: those of df, after the latest of seen so that at least
+    DEDUP_LOOKBACK digests are kept however small the chunks are.
+    """
+    digest = _row_digest(df)
+    keep = ~pd.Series(digest).duplicated().to_numpy() & ~np.isin(digest, seen)
+    return df[keep], np.concatenate((seen, digest))[-max(len(digest), DEDUP_LOOKBACK):]
+
+
+def _renumber(values, carry, last):
+    """
+    Streaming version of _count_changes.
+
+    carry is the (last value, last number) pair of the previous chunk, or None
+    for the first chunk, and last tells whether values ends the file. Returns
+    the new numbers and the carry for the next chunk.
+    """
+    changed = np.empty(len(values), dtype=bool)
+    changed[1:] = values[1:] != values[:-1]
+    changed[0] = carry is None or values[0] != carry[0]
+    if last:
+        changed[-1] = False
+    numbers = np.cumsum(changed, dtype=np.uint32) + (0 if carry is None else carry[1])
+    return numbers, (values[-1], numbers[-1])
+
+
+def _new_stream_state():
+    """Carry passed from chunk to chunk by iter_records and IncrementalReader"""
+    return {'record': None, 'step': None, 'rows': 0,
+            'prev': (np.nan, np.nan, np.datetime64('NaT', 'ns'), np.nan, np.nan),
+            'seen': np.empty(0, dtype=np.uint64), 'seen_aux': np.empty(0, dtype=np.uint64)}
+
+
+def _prepare_chunk(view, state, drop_early_steps):
+    """
+    Decode and deduplicate the main and aux records of one chunk of the
+    record view. A chunk without main (or aux) records leaves the digests
+    they are checked against as they were, so a record rewritten after an
+    empty chunk (e.g. an idle poll) is still dropped.
+    """
+    main, aux = _record_rows(view)
+    df = pd.DataFrame(_decode_records(view, main), columns=rec_columns)
+    if len(df):
+        df, state['seen'] = _drop_seen(df, state['seen'])
+    if drop_early_steps:
+        df = df[df['step_ID'] >= 7]
+    aux_df = pd.DataFrame(_decode_aux(view, aux), columns=aux_columns)
+    if len(aux_df):
+        aux_df, state['seen_aux'] = _drop_seen(aux_df, state['seen_aux'])
+    return df, aux_df
+
+
+def _finish_chunk(df, state, last):
+    """Renumber, timegap-validate and compute DCIR for one chunk of records"""
+    record_ID, state['record'] = _renumber(df['record_ID'].to_numpy(), state['record'], last)
+    step_ID, state['step'] = _renumber(df['step_ID'].to_numpy(), state['step'], last)
+    time_in_step = df['time_in_step'].to_numpy()
+    timestamp = df['timestamp'].to_numpy()
+    current = df['current_mA'].to_numpy()
+    voltage = df['voltage_V'].to_numpy()
+
+    # Values of the row before each row, starting with the end of the previous chunk
+    prev = state['prev']
+    prev_step = np.concatenate(([prev[0]], step_ID[:-1]))
+    prev_tis = np.concatenate(([prev[1]], time_in_step[:-1]))
+    prev_tstamp = np.concatenate(([prev[2]], timestamp[:-1]))
+    prev_cur = np.concatenate(([prev[3]], current[:-1]))
+    prev_vol = np.concatenate(([prev[4]], voltage[:-1]))
+    state['prev'] = (step_ID[-1], time_in_step[-1], timestamp[-1], current[-1], voltage[-1])
+
+    # Same rules as validate_timegap and the DCIR block of nda_in_df_out
+    validated = df['Validated'].to_numpy().copy()
+    gap = (time_in_step - prev_tis) - (timestamp - prev_tstamp) / np.timedelta64(1, 's')
+    validated[(abs(gap) > 5) & (step_ID == prev_step) & (time_in_step != 0)] = True
+
+    DCIR = dcir(voltage, current, prev_vol, prev_cur)
+
+    df = df.assign(record_ID=record_ID, step_ID=step_ID, Validated=validated, DCIR=DCIR)
+    df.index = pd.RangeIndex(state['rows'], state['rows'] + len(df))
+    state['rows'] += len(df)
+    return df.astype(dtype={col: dtype for col, dtype in dtype_dict.items() if col in df})
+
+
+def iter_records(file, chunk_size=1000000):
+    """
+    Decode an nda file in bounded memory.
+
+    The record region is walked chunk_size records at a time and a
+    (records, aux) pair of DataFrames is yielded per chunk. The record frames
+    have the columns of nda_in_df_out, without the joined temperature
+    columns: record/step renumbering, the timegap check and DCIR are carried
+    across chunk boundaries. A duplicated record is only dropped when the
+    record it copies is in the same chunk or among the last DEDUP_LOOKBACK
+    records of its kind before the chunk (or anywhere in the previous chunk,
+    when that holds more). nda_in_df_out compares the whole file, so the
+    chunks concatenate to its result only when every duplicate is that close
+    to its original. The aux frames hold the Index, Aux and T columns of the
+    auxiliary records read alongside the yielded records.
+    """
+    recs = _map_records(file)
+    drop_early_steps = get_barcode(file).startswith('0AD')
+
+    state = _new_stream_state()
+    # A chunk is held back until the next non-empty one is decoded, because
+    # _count_changes treats the very last record of the file differently.
+    pending = None
+    pending_aux = []
+    for start in range(0, len(recs), chunk_size):
+        df, aux_df = _prepare_chunk(recs[start:start + chunk_size], state, drop_early_steps)
+        if not df.empty:
+            if pending is not None:
+                yield _finish_chunk(pending, state, last=False), pd.concat(pending_aux, ignore_index=True)
+                pending_aux = []
+            pending = df
+        pending_aux.append(aux_df)
+
+    if pending is not None:
+        yield _finish_chunk(pending, state, last=True), pd.concat(pending_aux, ignore_index=True)
+
+
+class IncrementalReader:
+    """
+    Decodes an nda file that is still being written by BTS, a bit at a time.
+
+    Every call to records() decodes only the full records appended since the
+    previous call and appends them to the result so far; a partially written
+    record at the end of the file is left for the next call. The byte offset
+    of the record region, the number of records consumed, the renumbering
+    counters and the previous row (for the timegap check and DCIR) are kept
+    between calls, so refresh cost scales with the new data rather than with
+    the file size. The result matches iter_records concatenated over the
+    whole file. If the file shrinks it is decoded again from the start.
+    """
 
+    def __init__(self, file):
+        self.file = file
+        self._reset()
+
+    def _reset(self):
+        self.offset = None      # byte offset of the first record
+        self.consumed = 0       # number of 86 byte slots decoded so far
+        self.size = 0
+        self._state = _new_stream_state()
+        self._drop_early_steps = False
+        self._done = []         # finished record frames
+        self._pending = None    # last record, renumbered once more records arrive
+        self._aux = []
+        self._records = None
+
+    def update(self):
+        """
+        Decode the records appended since the last call. Returns the number
+        of new records.
+        """
+        size = os.path.getsize(self.file)
+        if size < self.size:
+            self._reset()
+        self.size = size
+        if self.offset is None:
+            # Wait for a couple of records before fixing the record offset,
+            # the header search cannot confirm it from a single record
+            try:
+                offset = record_offset(self.file)
+            except EOFError:
+                return 0
+            if offset + 2 * 86 > size:
+                return 0
+            self.offset = offset
+            self._drop_early_steps = get_barcode(self.file).startswith('0AD')
+
+        view = _map_records(self.file, self.offset, self.consumed)
+        self.consumed += len(view)
+        df, aux_df = _prepare_chunk(view, self._state, self._drop_early_steps)
+        del view
+        if not aux_df.empty:
+            self._aux.append(aux_df)
+        if df.empty:
+            return 0
+
+        if self._pending is not None:
+            df = pd.concat([self._pending, df])
+        if len(df) > 1:
+            self._done.append(_finish_chunk(df.iloc[:-1], self._state, last=False))
+        self._pending = df.iloc[-1:]
+        self._records = None
+        return len(df) - 1
+
+    def records(self):
+        """Refreshes and returns every record decoded so far"""
+        self.update()
+        if self._records is None:
+            frames = list(self._done)
+            if self._pending is not None:
+                frames.append(_finish_chunk(self._pending, dict(self._state), last=True))
+            if not frames:
+                return pd.DataFrame(columns=rec_columns + ['DCIR'])
+            self._records = pd.concat(frames)
+            # Keep the finished rows as one frame so later refreshes only
+            # concatenate it with the new rows
+            finished = len(self._records) - (self._pending is not None)
+            self._done = [self._records.iloc[:finished]]
+        return self._records
+
+    def aux(self):
+        """Returns every auxiliary record decoded so far"""
+        if len(self._aux) > 1:
+            self._aux = [pd.concat(self._aux, ignore_index=True)]
+        return self._aux[0] if self._aux else pd.DataFrame(columns=aux_columns)
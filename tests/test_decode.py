@@ -0,0 +1,148 @@
+# Decoding synthetic nda files: a few pinned values, and every reader
+# checked against the whole-file decode
+
+import numpy as np
+import pandas as pd
+import pytest
+from dateutil import tz
+
+import lime_nda
+from lime_nda import nda_cache, nda_index, nda_synthetic, nda_version_8_0
+
+# Second of the epoch written into one record's date fields by the epoch file
+EPOCH = 1700000000
+EPOCH_RECORD = 10
+
+
+@pytest.fixture(autouse=True)
+def no_cache():
+    directory = nda_cache._config['directory']
+    nda_cache.disable_cache()
+    yield
+    nda_cache._config['directory'] = directory
+
+
+@pytest.fixture(scope='module')
+def files(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('nda')
+    paths = {
+        'plain': nda_synthetic.write_nda(str(directory / 'plain.nda'), 3000, cycles=3, aux_channels=2,
+                                         ranges=(1000, -1000, 10)),
+        'duplicate': nda_synthetic.write_nda(str(directory / 'duplicate.nda'), 3000, cycles=3, aux_channels=2,
+                                             ranges=(1000, -1000, 10), duplicate_every=7),
+        '0AD': nda_synthetic.write_nda(str(directory / '0ad.nda'), 3000, cycles=3, aux_channels=1,
+                                       steps=(4, 7, 4, 2, 1, 3), barcode='0AD000000001'),
+        'epoch': nda_synthetic.write_nda(str(directory / 'epoch.nda'), 500, cycles=1),
+    }
+    # No aux records in the epoch file, so record i is slot i
+    offset = nda_version_8_0.record_offset(paths['epoch'])
+    with open(paths['epoch'], 'r+b') as f:
+        f.seek(offset + EPOCH_RECORD * 86 + 70)
+        f.write(np.uint64(EPOCH).tobytes())
+    return paths
+
+
+def test_pinned_values(files):
+    df = lime_nda.records(files['plain'])
+    assert len(df) == 3000
+    assert list(df.columns) == nda_version_8_0.rec_columns + ['T1', 'T2', 'DCIR']
+    # The last record keeps the number of the one before it (see _renumber)
+    assert (df['record_ID'].to_numpy() == np.append(np.arange(1, 3000), 2999)).all()
+    # 12 steps of 250 records over 3 cycles of rest, CCCV charge, rest, CC discharge
+    assert df['cycle'].iloc[[0, 999, 1000, 2999]].tolist() == [1, 1, 2, 3]
+    assert df['step_ID'].iloc[[0, 249, 250, 2999]].tolist() == [1, 1, 2, 12]
+    assert df['step_name'].iloc[[0, 250, 500, 750]].tolist() == [
+        nda_version_8_0.state_dict[code] for code in (4, 7, 4, 2)]
+    assert df['time_in_step'].iloc[[0, 249, 250]].tolist() == [0, 249, 0]
+    assert df['timestamp'].iloc[1] == pd.Timestamp('2024-01-01 00:00:01')
+    assert df['timestamp'].iloc[-1] == pd.Timestamp('2024-01-01 00:49:59')
+
+    raw = np.fromfile(files['plain'], dtype=nda_version_8_0._RECORD_DTYPE,
+                      offset=nda_version_8_0.record_offset(files['plain']))
+    main = raw[raw['marker'] == 0x55]
+    multiplier = np.array([nda_version_8_0.multiplier_dict[r] for r in main['range']])
+    assert (df['voltage_V'].to_numpy() == (main['voltage'] / 10000).astype(np.float32)).all()
+    assert (df['current_mA'].to_numpy() == (main['current'] * multiplier).astype(np.float32)).all()
+    aux = raw[raw['marker'] == 0x65]
+    assert np.isnan(df.loc[0, 'T1'])
+    assert df.loc[1, 'T2'] == np.float32(aux[(aux['index'] == 2) & (aux['aux'] == 2)]['temperature'][0] / 10)
+
+
+def test_duplicates_dropped(files):
+    pd.testing.assert_frame_equal(lime_nda.records(files['duplicate']), lime_nda.records(files['plain']))
+    pd.testing.assert_frame_equal(lime_nda.aux(files['duplicate']), lime_nda.aux(files['plain']))
+
+
+def test_0AD_drops_early_steps(files):
+    df = lime_nda.records(files['0AD'])
+    # Raw steps 1 to 6 (the first of the 18 runs of 166 or 167 records) are left out
+    assert len(df) == 3000 - 1000
+    assert df['record_ID'].iloc[0] == 1 and df['step_ID'].iloc[0] == 1
+    assert df['timestamp'].iloc[0] == pd.Timestamp('2024-01-01 00:16:40')
+
+
+def test_epoch_fallback(files):
+    timestamp = lime_nda.records(files['epoch'])['timestamp']
+    expected = pd.Timestamp(EPOCH, unit='s', tz='UTC').tz_convert(tz.tzlocal()).tz_localize(None)
+    assert timestamp.iloc[EPOCH_RECORD] == expected
+    assert timestamp.iloc[EPOCH_RECORD + 1] == pd.Timestamp('2024-01-01') + pd.Timedelta(seconds=EPOCH_RECORD + 1)
+
+
+@pytest.mark.parametrize('name', ['plain', 'duplicate', '0AD', 'epoch'])
+@pytest.mark.parametrize('options', [{}, {'compact': True}, {'validate': False}, {'aux': False}])
+def test_sharded_equals_serial(files, name, options, monkeypatch):
+    serial = nda_version_8_0.nda_in_df_out(files[name], **options)
+    monkeypatch.setattr(nda_version_8_0, 'MIN_SHARD_RECORDS', 0)
+    for workers in (2, 3):
+        pd.testing.assert_frame_equal(nda_version_8_0.nda_in_df_out(files[name], workers, **options), serial)
+
+
+@pytest.mark.parametrize('name', ['plain', 'duplicate', '0AD', 'epoch'])
+@pytest.mark.parametrize('chunk_size', [7, 1000, 1000000])
+def test_chunks_equal_records(files, name, chunk_size):
+    chunks = list(lime_nda.iter_records(files[name], chunk_size))
+    pd.testing.assert_frame_equal(pd.concat([df for df, _ in chunks]), lime_nda.records(files[name], aux=False))
+
+
+@pytest.mark.parametrize('name', ['plain', 'duplicate', '0AD'])
+def test_incremental_equals_records(files, name, tmp_path):
+    data = open(files[name], 'rb').read()
+    path = str(tmp_path / 'growing.nda')
+    with open(path, 'wb') as f:
+        f.write(data[:3000])
+    reader = lime_nda.IncrementalReader(path)
+    for end in range(3000, len(data) + 40000, 40000):
+        with open(path, 'wb') as f:
+            f.write(data[:end])
+        reader.records()
+    pd.testing.assert_frame_equal(reader.records(), lime_nda.records(files[name], aux=False))
+
+
+@pytest.mark.parametrize('name', ['plain', 'duplicate', '0AD', 'epoch'])
+def test_index_reads_equal_records(files, name):
+    df = lime_nda.records(files[name])
+    start, end = df['timestamp'].iloc[[100, 400]]
+    pd.testing.assert_frame_equal(lime_nda.records(files[name], cycles=[1]), df[df['cycle'] == 1])
+    pd.testing.assert_frame_equal(nda_index.read_cycles(files[name], [2, 3]), df[df['cycle'].isin([2, 3])])
+    pd.testing.assert_frame_equal(
+        lime_nda.records(files[name], columns=['voltage_V', 'timestamp'], time_range=(start, end)),
+        df.loc[(df['timestamp'] >= start) & (df['timestamp'] < end), ['voltage_V', 'timestamp']])
+    steps = lime_nda.step(df)
+    pd.testing.assert_frame_equal(lime_nda.step(files[name], steps=[2, 5]),
+                                  steps[steps['Step Number'].isin([2, 5])])
+
+
+@pytest.mark.parametrize('name', ['plain', 'duplicate', '0AD', 'epoch'])
+def test_summaries_equal_cycle_and_step(files, name):
+    df = lime_nda.records(files[name])
+    cycles, steps = lime_nda.summaries(files[name], 997)
+    pd.testing.assert_frame_equal(cycles, lime_nda.cycle(df))
+    pd.testing.assert_frame_equal(steps, lime_nda.step(df))
+
+
+@pytest.mark.parametrize('name', ['plain', 'duplicate', '0AD', 'epoch'])
+def test_lazy_validation_equals_eager(files, name):
+    flags, report = lime_nda.validate(lime_nda.records(files[name], validate=False))
+    for eager in (lime_nda.validate(lime_nda.records(files[name])), lime_nda.validate(files[name])):
+        pd.testing.assert_series_equal(flags, eager[0])
+        pd.testing.assert_frame_equal(report, eager[1])